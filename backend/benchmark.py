@@ -0,0 +1,276 @@
+"""
+Benchmarks of CMC, hydrogen bond detection and the plot builders on
+synthetic trajectories with planted ground truth
+
+    python benchmark.py run --atoms 2000 8000 --frames 200 --convoys 4 16 --output report.json
+    python benchmark.py compare base.json report.json
+    python benchmark.py generate data/synthetic.npy --atoms 4000 --frames 500
+
+Every case runs in its own forked process on a trajectory generated once per
+(atoms, frames, convoys), and is checked against the planted convoys and bonds.
+Reports are JSON, compare matches the cases of two reports and prints the
+speedups. Both commands exit with status 1 when a correctness check failed.
+"""
+import os, sys, json, time, argparse, datetime, platform, resource, tracemalloc, itertools
+import multiprocessing as mp
+import numpy as np
+
+from server.algorithms import CMC, CLUSTERING_ENGINES, get_clusterer, getHB
+from server.synthetic import SYNTHETIC_DENSITY, generate_trajectory, check_convoys, check_hbonds
+
+REPORT_VERSION = 1
+SUITES = ('cmc', 'hb', 'plots')
+# hydrogen bond engines: the N-O candidate search of hbond_triples
+HB_ENGINES = {'dense': False, 'kdtree': True}
+PLOT_BUILDERS = ('context', 'convoy', 'hb')
+
+def peak_rss():
+    """ Peak RSS in bytes of this process and its waited for children """
+    # ru_maxrss is in kilobytes on Linux
+    return 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def cmc_case(trajectory, engine, args, workers):
+    def run():
+        clf = get_clusterer(engine, args.eps, trajectory.box, trajectory.periodic, args.min_samples)
+        return CMC(clf, k=args.k, m=args.m, n_jobs=workers, chunk_size=args.chunk_size).fit_predict(trajectory.positions)
+    return run, lambda convoys: check_convoys(trajectory.convoys, convoys)
+
+def hb_case(trajectory, engine, args, workers):
+    frames = np.arange(len(trajectory.positions))
+    def run():
+        return getHB(trajectory.positions, trajectory.hb_atoms(), frames, trajectory.box, trajectory.periodic, neighbor_search=HB_ENGINES[engine])
+    return run, lambda hbonds: check_hbonds(trajectory.hbonds, hbonds)
+
+def plot_case(trajectory, engine, args, workers):
+    # the builders live with the plot generators, which need the web stack
+    from server.routes.jobs import convoy_labels, context_columns, convoy_columns, hb_columns
+
+    positions = trajectory.positions
+    frameCount, atomCount = positions.shape[:2]
+    frames = np.arange(frameCount)
+    if engine == 'context':
+        labels = convoy_labels(trajectory.convoys, atomCount)
+        def check(columns):
+            rows = frameCount * atomCount
+            owners = columns['Convoy'].reshape(frameCount, atomCount)[0]
+            passed = len(columns['X']) == rows and np.array_equal(columns['Z'], positions[..., 2].reshape(-1)) and \
+                all((owners[convoy.indices] == str(c)).all() for c, convoy in enumerate(trajectory.convoys) if c)
+            return {'rows': rows, 'passed': bool(passed)}
+        return lambda: context_columns(positions, frames, labels), check
+
+    if engine == 'convoy':
+        members = max(trajectory.convoys, key=lambda convoy: len(convoy.indices)).indices if trajectory.convoys else np.arange(0)
+        data = positions[:, members]
+        def check(columns):
+            rows = frameCount * len(members)
+            passed = len(columns['X']) == rows and np.array_equal(columns['Element_ID'][:len(members)], members)
+            return {'rows': rows, 'passed': bool(passed)}
+        return lambda: convoy_columns(data, frames, members), check
+
+    members = np.concatenate([indices for indices in trajectory.hb_atoms().values()])
+    data = positions[:, members]
+    def check(columns):
+        roles = columns['Hydrogen_Bonds'].reshape(frameCount, len(members))
+        position = {atom: i for i, atom in enumerate(members.tolist())}
+        expected = np.full(roles.shape, "None", dtype=object)
+        for frame, bonds in enumerate(trajectory.hbonds):
+            for bond in bonds:
+                expected[frame, [position[atom] for atom in bond]] = ["HN", "N", "O"]
+        return {'rows': roles.size, 'passed': bool((roles == expected).all())}
+    return lambda: hb_columns(data, trajectory.hbonds, members), check
+
+CASES = {'cmc': cmc_case, 'hb': hb_case, 'plots': plot_case}
+
+def run_case(conn, trajectory, suite, engine, args, workers):
+    """ Child process side of measure_case """
+    try:
+        run, check = CASES[suite](trajectory, engine, args, workers)
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            output = run()
+            times.append(time.perf_counter() - start)
+
+        # a separate traced run, tracing slows down the timed ones
+        tracemalloc.start()
+        run()
+        peakAlloc = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        conn.send({'times': times, 'peak_alloc_bytes': peakAlloc, 'peak_rss_bytes': peak_rss(), 'check': check(output)})
+    except Exception as error:
+        conn.send({'error': f'{type(error).__name__}: {error}'})
+    finally:
+        conn.close()
+
+def measure_case(trajectory, suite, engine, args, workers=1):
+    """
+    Time one case in a forked process
+
+    peak_alloc_bytes are the Python and Numpy allocations of the case process
+    (pool workers are not traced), peak_rss_bytes the peak RSS of the case
+    process, including the trajectory it inherits, and of its workers.
+    """
+    receive, send = mp.Pipe(duplex=False)
+    process = mp.get_context('fork').Process(target=run_case, args=(send, trajectory, suite, engine, args, workers))
+    process.start()
+    send.close()
+    try:
+        result = receive.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        result = {'error': f'case process exited with code {process.exitcode}'}
+
+    frames, atoms = trajectory.positions.shape[:2]
+    row = {'suite': suite, 'engine': engine, 'workers': workers, 'atoms': atoms, 'frames': frames, 'convoys': len(trajectory.convoys)}
+    if 'error' in result:
+        row.update(error=result['error'], check={'passed': False})
+        return row
+    seconds = min(result['times'])
+    row.update({
+        'seconds': seconds,
+        'times': result['times'],
+        'frames_per_second': frames / seconds if seconds else None,
+        'atom_frames_per_second': frames * atoms / seconds if seconds else None,
+        'peak_alloc_bytes': result['peak_alloc_bytes'],
+        'peak_rss_bytes': result['peak_rss_bytes'],
+        'check': result['check']
+    })
+    return row
+
+def machine_info():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count()
+    }
+
+def trajectory_settings(args):
+    return {
+        'convoy_size': tuple(args.convoy_size),
+        'lifetime': tuple(args.lifetime),
+        'hbond_sites': args.hbond_sites,
+        'density': args.density,
+        'seed': args.seed
+    }
+
+def run_benchmarks(args):
+    results = []
+    for atoms, frames, convoys in itertools.product(args.atoms, args.frames, args.convoys):
+        trajectory = generate_trajectory(frames=frames, atoms=atoms, convoys=convoys, **trajectory_settings(args))
+        cases = []
+        if 'cmc' in args.suites:
+            cases += [('cmc', engine, workers) for engine in args.engines for workers in args.workers]
+        if 'hb' in args.suites:
+            cases += [('hb', engine, 1) for engine in HB_ENGINES]
+        if 'plots' in args.suites:
+            cases += [('plots', engine, 1) for engine in PLOT_BUILDERS]
+
+        for suite, engine, workers in cases:
+            row = measure_case(trajectory, suite, engine, args, workers)
+            results.append(row)
+            status = 'ok' if row['check']['passed'] else 'FAILED'
+            timing = row.get('error') or '%.3fs %.0f frames/s' % (row['seconds'], row['frames_per_second'] or 0)
+            print(f'{suite:6} {engine:16} workers={workers} atoms={atoms} frames={frames} convoys={convoys}: {timing} [{status}]', flush=True)
+
+    report = {
+        'version': REPORT_VERSION,
+        'created': datetime.datetime.utcnow().isoformat(),
+        'machine': machine_info(),
+        'settings': dict(trajectory_settings(args), eps=args.eps, k=args.k, m=args.m, min_samples=args.min_samples,
+                         chunk_size=args.chunk_size),
+        'repeat': args.repeat,
+        'results': results
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=1)
+    print(f'Report written to {args.output}')
+    return all(row['check']['passed'] for row in results)
+
+def case_key(row):
+    return row['suite'], row['engine'], row['workers'], row['atoms'], row['frames'], row['convoys']
+
+def compare_reports(args):
+    with open(args.base) as file:
+        base = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+    if base['settings'] != new['settings']:
+        print('Warning: the reports were run with different settings')
+
+    baseRows = {case_key(row): row for row in base['results']}
+    passed = True
+    print('%-6s %-16s %7s %7s %7s %8s %10s %10s %8s %s' % ('suite', 'engine', 'workers', 'atoms', 'frames', 'convoys', 'base s', 'new s', 'speedup', 'check'))
+    for row in new['results']:
+        old = baseRows.get(case_key(row))
+        check = 'ok' if row['check']['passed'] else 'FAILED'
+        passed = passed and row['check']['passed']
+        if old is None or 'seconds' not in old or 'seconds' not in row:
+            speedup, oldSeconds = '-', '-'
+        else:
+            speedup, oldSeconds = '%.2fx' % (old['seconds'] / row['seconds']), '%.3f' % old['seconds']
+            # a faster case that changed its output is not a speedup
+            if old['check'] != row['check']:
+                check += ' (changed)'
+        print('%-6s %-16s %7d %7d %7d %8d %10s %10s %8s %s' % (*case_key(row), oldSeconds, '%.3f' % row['seconds'] if 'seconds' in row else '-', speedup, check))
+    return passed
+
+def generate_dataset(args):
+    trajectory = generate_trajectory(frames=args.frames, atoms=args.atoms, convoys=args.convoys, **trajectory_settings(args))
+    trajectory.save(args.path, args.atom_types)
+    with open(f'{args.path}.truth.json', 'w') as file:
+        json.dump({
+            'convoys': [{'indices': convoy.indices.tolist(), 'start_time': convoy.start_time, 'end_time': convoy.end_time} for convoy in trajectory.convoys],
+            'hbonds': trajectory.hbonds
+        }, file)
+    print(f'{trajectory!r} written to {args.path}')
+    return True
+
+def add_trajectory_arguments(parser):
+    parser.add_argument('--convoy-size', type=int, nargs=2, default=(8, 16), metavar=('LOW', 'HIGH'), help='members of a planted convoy')
+    parser.add_argument('--lifetime', type=int, nargs=2, default=(10, 40), metavar=('LOW', 'HIGH'), help='frames of a planted convoy')
+    parser.add_argument('--hbond-sites', type=int, default=16, help='planted hydrogen bond sites')
+    parser.add_argument('--density', type=float, default=SYNTHETIC_DENSITY, help='atoms per cubic Angstrom, sets the box')
+    parser.add_argument('--seed', type=int, default=0)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='run the benchmarks and write a report')
+    run.add_argument('--atoms', type=int, nargs='+', default=[2000])
+    run.add_argument('--frames', type=int, nargs='+', default=[100])
+    run.add_argument('--convoys', type=int, nargs='+', default=[4])
+    run.add_argument('--suites', nargs='+', choices=SUITES, default=list(SUITES))
+    run.add_argument('--engines', nargs='+', choices=CLUSTERING_ENGINES, default=list(CLUSTERING_ENGINES))
+    run.add_argument('--workers', type=int, nargs='+', default=[1], help='CMC clustering workers')
+    run.add_argument('--eps', type=float, default=3.5)
+    run.add_argument('--k', type=int, default=5)
+    run.add_argument('--m', type=int, default=8)
+    run.add_argument('--min-samples', type=int, default=5)
+    run.add_argument('--chunk-size', type=int, default=64)
+    run.add_argument('--repeat', type=int, default=3, help='timed runs per case, the fastest counts')
+    run.add_argument('--output', default='benchmark.json')
+    add_trajectory_arguments(run)
+
+    compare = commands.add_parser('compare', help='compare the cases of two reports')
+    compare.add_argument('base')
+    compare.add_argument('new')
+
+    generate = commands.add_parser('generate', help='write a synthetic dataset with its ground truth')
+    generate.add_argument('path')
+    generate.add_argument('--atoms', type=int, default=2000)
+    generate.add_argument('--frames', type=int, default=100)
+    generate.add_argument('--convoys', type=int, default=4)
+    generate.add_argument('--atom-types', help='also write the atom types pickle here')
+    add_trajectory_arguments(generate)
+
+    args = parser.parse_args(argv)
+    command = {'run': run_benchmarks, 'compare': compare_reports, 'generate': generate_dataset}[args.command]
+    return 0 if command(args) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,125 @@
+import os, copy, time
 import numpy as np
 import pickle
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from sklearn.cluster import DBSCAN
 
 def getCoordinates(data, index):
     return data[index]
 
-def coordinate_transform (x):
-    x = 72.475 + x  if x < 0 else x
-    return x
+# Version of the convoy detection output, bump when results of identical jobs change
+ALGORITHM_VERSION = 1
+
+# Simulation box of the sample membrane trajectories. X and Y are periodic,
+# Z is not (its length is ignored while the axis is non-periodic).
+BOX_SIZE = (72.475, 72.475, 72.475)
+PERIODIC_AXES = (True, True, False)
+
+def box_vectors(box=None, periodic=None):
+    """
+    Normalize box dimensions and per-axis periodicity
+
+    Parameters
+    ----------
+    box : scalar or sequence of 3, optional
+        Box length along each axis (defaults to BOX_SIZE)
+    periodic : bool or sequence of 3 bools, optional
+        Whether each axis is periodic (defaults to PERIODIC_AXES)
+
+    Returns
+    -------
+    box: Numpy 1D array of shape (3,)
+    periodic: Numpy 1D bool array of shape (3,)
+
+    """
+    box = np.broadcast_to(np.asarray(BOX_SIZE if box is None else box, dtype=np.float64), (3,))
+    periodic = np.broadcast_to(np.asarray(PERIODIC_AXES if periodic is None else periodic, dtype=bool), (3,))
+    return box, periodic
+
+def wrap_axis (x, length):
+    """ Shift negative coordinates of one axis into the box (elementwise) """
+    return np.where(x < 0, length + x, x)
+
+def image_axis (diff, length):
+    """
+    Periodic difference of already wrapped coordinates of one axis (elementwise)
+
+    Keeps the sign convention of the original scalar code: the magnitude is the
+    minimum image distance, the sign is the one of the raw difference.
+    """
+    diff = np.asarray(diff)
+    abs_diff = np.abs(diff)
+    return np.where(abs_diff > length / 2, np.sign(diff) * (length - abs_diff), diff)
+
+def wrap_positions(X, box=None, periodic=None):
+    """
+    Wrap the periodic axes of a coordinate array once
+
+    Parameters
+    ----------
+    X : Numpy array of shape (..., 3)
+        Coordinates, e.g. atoms x 3 or frames x atoms x 3
+    box, periodic : see box_vectors
+
+    Returns
+    -------
+    Numpy array of the same shape with negative periodic coordinates shifted by the box length.
+    Single precision input stays in single precision.
+
+    """
+    box, periodic = box_vectors(box, periodic)
+    X = np.asarray(X)
+    box = box.astype(np.result_type(X, np.float32))
+    return np.where(periodic & (X < 0), box + X, X)
+
+def periodic_displacement(X1, X2, box=None, periodic=None, wrapped=False):
+    """
+    Vectorized periodic displacement X2 - X1
+
+    Parameters
+    ----------
+    X1, X2 : Numpy arrays of shape (..., 3)
+        Coordinates, broadcast against each other
+    box, periodic : see box_vectors
+    wrapped : bool
+        Set when X1 and X2 already went through wrap_positions, so that the
+        wrapping is done once per array instead of on every call
+
+    Returns
+    -------
+    Numpy array of shape (..., 3) of periodic coordinate differences
 
-def periodic_boundary (x1, x2):
+    """
+    box, periodic = box_vectors(box, periodic)
+    if not wrapped:
+        X1 = wrap_positions(X1, box, periodic)
+        X2 = wrap_positions(X2, box, periodic)
+    diff = np.asarray(X2) - np.asarray(X1)
+    box = box.astype(np.result_type(diff, np.float32))
+    return np.where(periodic, image_axis(diff, box), diff)
+
+def periodic_distance(X1, X2, box=None, periodic=None, wrapped=False):
+    """
+    Vectorized periodic euclidean distance between X1 and X2
+
+    Returns
+    -------
+    distance: Numpy array of shape (...)
+    diff: Numpy array of shape (..., 3), see periodic_displacement
+
+    """
+    diff = periodic_displacement(X1, X2, box, periodic, wrapped)
+    return np.sqrt(np.sum(np.square(diff), axis=-1)), diff
+
+def coordinate_transform (x, length=BOX_SIZE[0]):
+    return wrap_axis(x, length)[()]
+
+def periodic_boundary (x1, x2, length=BOX_SIZE[0]):
     """
     Apply periodic boundaries
     Periodic Boundaries in X and Y direction is 72 A.
@@ -28,22 +139,16 @@ def periodic_boundary (x1, x2):
     ----------
     x1 : axis coordinates of atom 1  
     x2 : axis coordinates of atom 2 
+    length : box length along the axis
 
     Returns
     -------
     differences of coordinates values with periodicity
 
     """
-    
-    x1 = coordinate_transform (x1)
-    
-    x2 = coordinate_transform (x2)
-
-    coord_diff = ((x2 - x1)/abs(x2 - x1))*(72.475-abs(x2 - x1)) if abs(x2 - x1)>36.2375 else (x2 - x1)
-    
-    return coord_diff
+    return image_axis(wrap_axis(x2, length) - wrap_axis(x1, length), length)[()]
 
-def distance_periodicity (atom1, atom2):
+def distance_periodicity (atom1, atom2, box=None, periodic=None):
     
     """
     Apply periodic boundaries
@@ -63,37 +168,26 @@ def distance_periodicity (atom1, atom2):
     
     Euclidean Shortest Distance = √(〖"(Distance in X axis)" 〗^2+〖"(Distance in Y axis)" 〗^2+〖"(Distance in Z axis)" 〗^2 )
 
+    Thin wrapper around periodic_distance for a single pair of atoms.
+
     Parameters
     ----------
-    X1 : Numpy 1D array
-        x axis coordinates of atom 1 trajectory
-    Y1 : Numpy 1D array
-        y axis coordinates of atom 1 trajectory 
-    Z1 : Numpy 1D array
-        z axis coordinates of atom 1 trajectory 
-    X2 : Numpy 1D array
-        x axis coordinates of atom 2 trajectory 
-    Y2 : Numpy 1D array
-        y axis coordinates of atom 2 trajectory 
-    Z2 : Numpy 1D array
-        z axis coordinates of atom 2 trajectory 
+    atom1 : sequence of 3
+        x, y, z coordinates of atom 1
+    atom2 : sequence of 3
+        x, y, z coordinates of atom 2
+    box, periodic : see box_vectors
 
     Returns
     -------
-    distance: Numpy 1D array
-            Euclidean distance of (X1,Y1,Z1) and (X2,Y2,Z2)
+    distance: Euclidean distance of atom1 and atom2
+    x_coord_diff, y_coord_diff, z_coord_diff: periodic coordinate differences
 
     """
 
-    x_coord_diff = periodic_boundary (atom1[0], atom2[0])
-        
-    y_coord_diff = periodic_boundary (atom1[1], atom2[1])
+    euclidean_distance, diff = periodic_distance(atom1, atom2, box, periodic)
 
-    z_coord_diff = (atom2[2]-atom1[2])
-
-    euclidean_distance = np.sqrt(np.square(x_coord_diff) + np.square(y_coord_diff) + np.square(z_coord_diff))
-    
-    return euclidean_distance, x_coord_diff, y_coord_diff, z_coord_diff
+    return euclidean_distance[()], diff[0], diff[1], diff[2]
 
 def calc_angle (vector1,vector2):
     
@@ -103,33 +197,196 @@ def calc_angle (vector1,vector2):
     angle = np.arccos(c)
     return angle
 
-def HB_truth(hn, n, o):
-    euclidean_distance_no, x_coord_diff_no, y_coord_diff_no, z_coord_diff_no = distance_periodicity(n, o)
-    euclidean_distance_hnn, x_coord_diff_hnn, y_coord_diff_hnn, z_coord_diff_hnn = distance_periodicity(hn, n)
-    euclidean_distance_hno, x_coord_diff_hno, y_coord_diff_hno, z_coord_diff_hno = distance_periodicity(hn, o)
+# Hydrogen bond criteria: N-O distance (A) and H-N...O angle range (radians)
+HB_DISTANCE = 3.5
+HB_MIN_ANGLE = 2.35619
+HB_MAX_ANGLE = 3.14159
+
+# Number of N and O atoms from which N-O candidates come from a KD-tree
+NEIGHBOR_SEARCH_ATOMS = 256
+
+def HB_truth(hn, n, o, box=None, periodic=None, distance=HB_DISTANCE, min_angle=HB_MIN_ANGLE, max_angle=HB_MAX_ANGLE):
+    euclidean_distance_no, x_coord_diff_no, y_coord_diff_no, z_coord_diff_no = distance_periodicity(n, o, box, periodic)
+    euclidean_distance_hnn, x_coord_diff_hnn, y_coord_diff_hnn, z_coord_diff_hnn = distance_periodicity(hn, n, box, periodic)
+    euclidean_distance_hno, x_coord_diff_hno, y_coord_diff_hno, z_coord_diff_hno = distance_periodicity(hn, o, box, periodic)
     
     vector_hnn = [x_coord_diff_hnn, y_coord_diff_hnn, z_coord_diff_hnn]
     vector_hno = [x_coord_diff_hno, y_coord_diff_hno, z_coord_diff_hno]
 
     angle = calc_angle(vector_hno, vector_hnn)
 
-    if (angle > 2.35619) and  (angle <= 3.14159) and euclidean_distance_no <= 3.5:
+    if (angle > min_angle) and  (angle <= max_angle) and euclidean_distance_no <= distance:
         return True
     return False
 
-def HBCheck(data, HBatoms, column):
-    for hn in HBatoms["hn"]:
-        for n in HBatoms["n"]:
-            coord_hn = getCoordinates(data[column], hn)
-            coord_n = getCoordinates(data[column], n)
-            for o in HBatoms["o"]:
-                coord_o = getCoordinates(data[column], o)
-                if HB_truth(coord_hn, coord_n, coord_o):
-                    return True, [hn, n, o]
+def cos_below(dot, norms2, threshold):
+    """
+    Elementwise dot / sqrt(norms2) < threshold, without sqrt or division
+
+    Parameters
+    ----------
+    dot : Numpy array of dot products
+    norms2 : Numpy array of products of the squared vector lengths
+    threshold : cosine threshold
+
+    """
+    if threshold >= 0:
+        return (dot < 0) | (dot * dot < threshold * threshold * norms2)
+    return (dot < 0) & (dot * dot > threshold * threshold * norms2)
+
+def hbond_pairs(frames, hn, n, o, no_pairs, box=None, periodic=None, min_angle=HB_MIN_ANGLE, max_angle=HB_MAX_ANGLE, wrapped=False):
+    """
+    Angle test of every hydrogen against candidate N-O pairs
+
+    Parameters
+    ----------
+    frames : Numpy array of shape (frames, atoms, 3)
+        Block of frames to evaluate
+    hn, n, o : Numpy 1D int arrays
+        Atom indices of the hydrogens, nitrogens and oxygens
+    no_pairs : tuple of 3 Numpy 1D int arrays
+        (frame, position in n, position in o) of the N-O pairs within the distance cutoff
+    box, periodic : see box_vectors
+    min_angle, max_angle : H-N...O angle range in radians
+    wrapped : bool
+        Set when frames already went through wrap_positions
+
+    Returns
+    -------
+    bonds: Numpy int array of shape (bonds, 4)
+        Rows of (frame, hn, n, o), frame relative to the block, ordered by frame
+        and then by the position of hn, n and o in their index arrays
+
+    """
+    frame_idx, n_pos, o_pos = no_pairs
+    if len(frame_idx) == 0 or len(hn) == 0:
+        return np.empty((0, 4), dtype=np.int64)
+    if not wrapped:
+        frames = wrap_positions(frames, box, periodic)
+
+    coord_hn = frames[frame_idx[:, None], hn[None, :]]
+    vector_hnn = periodic_displacement(coord_hn, frames[frame_idx, n[n_pos]][:, None], box, periodic, wrapped=True)
+    vector_hno = periodic_displacement(coord_hn, frames[frame_idx, o[o_pos]][:, None], box, periodic, wrapped=True)
+
+    # angle > min_angle <=> cos < cos(min_angle) and angle <= max_angle <=> cos >= cos(max_angle)
+    dot = np.einsum('ijk,ijk->ij', vector_hno, vector_hnn)
+    norms2 = np.einsum('ijk,ijk->ij', vector_hno, vector_hno) * np.einsum('ijk,ijk->ij', vector_hnn, vector_hnn)
+    bonded = (norms2 > 0) & cos_below(dot, norms2, np.cos(min_angle)) & ~cos_below(dot, norms2, np.cos(max_angle))
+
+    pair, h_pos = np.nonzero(bonded)
+    order = np.lexsort((o_pos[pair], n_pos[pair], h_pos, frame_idx[pair]))
+    pair, h_pos = pair[order], h_pos[order]
+    return np.stack((frame_idx[pair], hn[h_pos], n[n_pos[pair]], o[o_pos[pair]]), axis=1)
+
+def box_positions(X, box=None, periodic=None):
+    """
+    Fold the periodic axes of a coordinate array into [0, box), as required by cKDTree
+
+    Non-periodic axes are returned unchanged, the returned boxsize is 0 along them.
+
+    Returns
+    -------
+    positions: Numpy array of the same shape as X
+    boxsize: Numpy 1D array of shape (3,) to pass to cKDTree
+
+    """
+    box, periodic = box_vectors(box, periodic)
+    boxsize = np.where(periodic, box, 0.0)
+    X = np.asarray(X, dtype=np.float64)
+    folded = np.mod(X, box)
+    # np.mod can round tiny negative values up to the box length itself
+    folded = np.where(folded >= box, folded - box, folded)
+    return np.where(periodic, folded, X), boxsize
+
+def neighbor_pairs(frames, n, o, distance=HB_DISTANCE, box=None, periodic=None):
+    """
+    Candidate N-O pairs within the distance cutoff from a periodic KD-tree per frame
+
+    Parameters
+    ----------
+    frames : Numpy array of shape (frames, atoms, 3)
+    n, o : Numpy 1D int arrays of atom indices
+    distance : N-O distance cutoff
+    box, periodic : see box_vectors
+
+    Returns
+    -------
+    (frame, position in n, position in o) Numpy 1D int arrays. The search radius
+    is padded slightly, callers re-check the exact distance.
+
+    """
+    frame_idx, n_pos, o_pos = [], [], []
+    radius = distance * (1 + 1e-9)
+    for f, frame in enumerate(frames):
+        coords_n, boxsize = box_positions(frame[n], box, periodic)
+        coords_o, _ = box_positions(frame[o], box, periodic)
+        tree_n = cKDTree(coords_n, boxsize=boxsize)
+        tree_o = cKDTree(coords_o, boxsize=boxsize)
+        pairs = tree_n.sparse_distance_matrix(tree_o, radius, output_type='ndarray')
+        frame_idx.append(np.full(len(pairs), f, dtype=np.int64))
+        n_pos.append(pairs['i'].astype(np.int64))
+        o_pos.append(pairs['j'].astype(np.int64))
+    if not frame_idx:
+        return (np.empty(0, dtype=np.int64),) * 3
+    return np.concatenate(frame_idx), np.concatenate(n_pos), np.concatenate(o_pos)
+
+def hbond_triples(frames, hn, n, o, box=None, periodic=None, distance=HB_DISTANCE, min_angle=HB_MIN_ANGLE, max_angle=HB_MAX_ANGLE, neighbor_search=None):
+    """
+    Batched hydrogen bond detection over every (H, N, O) triple of a block of frames
+
+    N-O pairs are first rejected on squared distance, only the remaining pairs
+    go through the angle test, which compares cosines instead of calling arccos.
+    Large atom sets find the N-O candidates with a periodic KD-tree per frame
+    instead of testing every pair.
+
+    Parameters
+    ----------
+    frames : Numpy array of shape (frames, atoms, 3)
+    hn, n, o : sequences of atom indices
+    box, periodic : see box_vectors
+    distance : N-O distance cutoff
+    min_angle, max_angle : H-N...O angle range in radians
+    neighbor_search : bool, optional
+        Force the KD-tree candidate search on or off, by default it is used
+        once there are NEIGHBOR_SEARCH_ATOMS or more N and O atoms
+
+    Returns
+    -------
+    bonds: Numpy int array of shape (bonds, 4), see hbond_pairs
+
+    """
+    hn, n, o = (np.asarray(indices, dtype=np.int64).reshape(-1) for indices in (hn, n, o))
+    frames = wrap_positions(frames, box, periodic)
+    if len(n) == 0 or len(o) == 0:
+        return np.empty((0, 4), dtype=np.int64)
+
+    if neighbor_search is None:
+        neighbor_search = len(n) + len(o) >= NEIGHBOR_SEARCH_ATOMS
+
+    if neighbor_search:
+        frame_idx, n_pos, o_pos = neighbor_pairs(frames, n, o, distance, box, periodic)
+        vector_no = periodic_displacement(frames[frame_idx, n[n_pos]], frames[frame_idx, o[o_pos]], box, periodic, wrapped=True)
+        close = np.einsum('ij,ij->i', vector_no, vector_no) <= distance * distance
+        no_pairs = (frame_idx[close], n_pos[close], o_pos[close])
+    else:
+        vector_no = periodic_displacement(frames[:, n, None], frames[:, None, o], box, periodic, wrapped=True)
+        no_pairs = np.nonzero(np.einsum('ijkl,ijkl->ijk', vector_no, vector_no) <= distance * distance)
+    return hbond_pairs(frames, hn, n, o, no_pairs, box, periodic, min_angle, max_angle, wrapped=True)
+
+def group_bonds(bonds, frames):
+    """ Split (frame, hn, n, o) rows into one list of [hn, n, o] per frame """
+    grouped = [[] for _ in range(frames)]
+    for row in bonds.tolist():
+        grouped[row[0]].append(row[1:])
+    return grouped
+
+def HBCheck(data, HBatoms, column, box=None, periodic=None, **criteria):
+    bonds = hbond_triples(data[column:column + 1], HBatoms["hn"], HBatoms["n"], HBatoms["o"], box, periodic, **criteria)
+    if len(bonds):
+        return True, bonds[0, 1:].tolist()
     
     return False, None
 
-
 def getAtomTypes(file_path):
     with open(file_path, "rb") as file:
         atomTypes = pickle.load(file)
@@ -142,24 +399,349 @@ def find_key_by_value(input_value, dictionary):
             return key
     return None
 
-def getClusterHB(data, convoy_cluster_indices, atomTypes, timeFrame):
-    atomsIHave = {
-        "n": [],
-        "hn": [],
-        "o": []
-    }
-    for index in convoy_cluster_indices:
-        if not find_key_by_value(index, atomTypes) == None:
-            atomsIHave[find_key_by_value(index, atomTypes)].append(index)
-    
-    HB, HBatoms = HBCheck(data, atomsIHave, timeFrame)
+class AtomTypeIndex(object):
+    """Dense per-atom type codes, built once instead of scanning the atom type dict per atom
+
+    Attributes:
+        names (list): The atom type names, code i stands for names[i]
+        codes (ndarray): The type code of every atom index, -1 for untyped atoms
+    """
+    __slots__ = ('names', 'codes')
+
+    def __init__(self, names, codes):
+        self.names = list(names)
+        self.codes = np.asarray(codes)
+
+    @classmethod
+    def from_dict(cls, atomTypes):
+        names = list(atomTypes.keys())
+        size = max((max(value) + 1 for value in atomTypes.values() if len(value)), default=0)
+        codes = np.full(size, -1, dtype=np.int16)
+        # an atom listed under several types keeps the first one, like find_key_by_value
+        for code in reversed(range(len(names))):
+            codes[np.asarray(list(atomTypes[names[code]]), dtype=np.int64)] = code
+        return cls(names, codes)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as cache:
+            return cls(cache['names'].tolist(), cache['codes'])
+
+    def save(self, file_path):
+        tmp_path = file_path + '.tmp.npz'
+        np.savez(tmp_path, names=np.asarray(self.names, dtype=str), codes=self.codes)
+        os.replace(tmp_path, file_path)
+
+    def type_of(self, indices):
+        """ Type codes of the given atom indices, -1 for untyped or unknown atoms """
+        indices = np.asarray(indices, dtype=np.int64)
+        known = (indices >= 0) & (indices < len(self.codes))
+        return np.where(known, self.codes[np.where(known, indices, 0)], -1)
+
+    def group(self, indices, types=("n", "hn", "o")):
+        """
+        Group atom indices by type, keeping their order
+
+        Returns
+        -------
+        dict of type name to Numpy 1D int array of atom indices
+        """
+        indices = np.fromiter(indices, dtype=np.int64)
+        codes = self.type_of(indices)
+        grouped = {}
+        for name in types:
+            grouped[name] = indices[codes == self.names.index(name)] if name in self.names else indices[:0]
+        return grouped
+
+def getAtomTypeIndex(file_path):
+    """
+    Atom type index of an atom type pickle, cached as a .npz next to it
+
+    The cache is rebuilt whenever the pickle is newer than it.
+    """
+    cache_path = os.path.splitext(file_path)[0] + '.npz'
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file_path):
+        return AtomTypeIndex.load(cache_path)
+
+    index = AtomTypeIndex.from_dict(getAtomTypes(file_path))
+    try:
+        index.save(cache_path)
+    except OSError:
+        pass
+    return index
+
+def getHB(data, HBatoms, timeFrame, box=None, periodic=None, **criteria):
+    """
+    Hydrogen bonds between grouped atoms
+
+    Parameters
+    ----------
+    data : Numpy array of shape (frames, atoms, 3)
+    HBatoms : dict of "hn", "n" and "o" atom indices, see AtomTypeIndex.group
+    timeFrame : sequence of frames to evaluate
+    box, periodic : see box_vectors
+    criteria : distance, min_angle, max_angle and neighbor_search, see hbond_triples
+
+    Returns
+    -------
+    list with one list of [hn, n, o] bonds per frame of timeFrame
+
+    """
+    timeFrame = np.asarray(timeFrame)
+    bonds = hbond_triples(data[timeFrame], HBatoms["hn"], HBatoms["n"], HBatoms["o"], box, periodic, **criteria)
+
+    return group_bonds(bonds, len(timeFrame))
+
+def getClusterHB(data, convoy_cluster_indices, atomTypes, timeFrame, box=None, periodic=None, **criteria):
+    """
+    Hydrogen bonds inside a convoy
+
+    Parameters
+    ----------
+    data : Numpy array of shape (frames, atoms, 3)
+    convoy_cluster_indices : atom indices of the convoy
+    atomTypes : AtomTypeIndex, or dict of atom type ("n", "hn", "o") to atom indices
+    timeFrame : sequence of frames to evaluate
+    box, periodic : see box_vectors
+    criteria : see getHB
+
+    Returns
+    -------
+    list with one list of [hn, n, o] bonds per frame of timeFrame
+
+    """
+    if not isinstance(atomTypes, AtomTypeIndex):
+        atomTypes = AtomTypeIndex.from_dict(atomTypes)
+
+    return getHB(data, atomTypes.group(convoy_cluster_indices), timeFrame, box, periodic, **criteria)
+
+def first_appearance_labels(labels):
+    """ Renumber non-negative labels 0, 1, ... in order of first appearance, keeping -1 """
+    labels = np.asarray(labels)
+    clustered = labels >= 0
+    _, first, inverse = np.unique(labels[clustered], return_index=True, return_inverse=True)
+    renumbered = np.full(len(labels), -1, dtype=np.int64)
+    renumbered[clustered] = np.argsort(np.argsort(first))[inverse]
+    return renumbered
+
+class RadiusGraphClustering(object):
+    """Periodic radius-graph clustering engine for CMC
+
+    Points closer than eps under the periodic box are linked by a periodic
+    KD-tree, clusters are the connected components of that graph. With
+    min_samples set, DBSCAN core-point semantics apply instead: only core
+    points (at least min_samples points, itself included, within eps) link
+    clusters, border points join the cluster of their lowest indexed core neighbor
+    and the rest is noise (-1).
+
+    Attributes:
+        eps (float): The neighborhood radius
+        min_samples (int): The DBSCAN core-point threshold, None for plain connected components
+        box: The box dimensions, see box_vectors
+        periodic: The axis periodicity, see box_vectors
+    """
+    def __init__(self, eps=3.5, min_samples=None, box=None, periodic=None):
+        self.eps = eps
+        self.min_samples = min_samples
+        self.box = box
+        self.periodic = periodic
+
+    def neighbor_graph(self, X):
+        """ (i, j) Numpy int arrays of the point pairs within eps, i < j """
+        positions, boxsize = box_positions(X, self.box, self.periodic)
+        pairs = cKDTree(positions, boxsize=boxsize).query_pairs(self.eps, output_type='ndarray')
+        return pairs[:, 0], pairs[:, 1]
+
+    def fit_predict(self, X, y=None, sample_weight=None):
+        X = np.asarray(X, dtype=np.float64)
+        size = len(X)
+        if size == 0:
+            return np.empty(0, dtype=np.int64)
+        X = X.reshape(size, -1)
+        i, j = self.neighbor_graph(X)
+        return self.graph_labels(i, j, size, sample_weight)
+
+    def graph_labels(self, i, j, size, sample_weight=None):
+        """ Cluster labels of size points from the (i, j) pairs of their eps-radius graph """
+        if self.min_samples is None:
+            graph = coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(size, size))
+            _, labels = connected_components(graph, directed=False)
+            return first_appearance_labels(labels)
+
+        weight = np.ones(size) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+        neighborhood = weight + np.bincount(i, weights=weight[j], minlength=size) + np.bincount(j, weights=weight[i], minlength=size)
+        core = neighborhood >= self.min_samples
+
+        core_edges = core[i] & core[j]
+        graph = coo_matrix((np.ones(core_edges.sum(), dtype=np.int8), (i[core_edges], j[core_edges])), shape=(size, size))
+        _, components = connected_components(graph, directed=False)
+        labels = np.where(core, components, -1)
+
+        # border points take the label of their lowest indexed core neighbor
+        border_i = np.concatenate((i[core[j] & ~core[i]], j[core[i] & ~core[j]]))
+        border_core = np.concatenate((j[core[j] & ~core[i]], i[core[i] & ~core[j]]))
+        order = np.lexsort((border_core, border_i))[::-1]
+        labels[border_i[order]] = components[border_core[order]]
+        return first_appearance_labels(labels)
+
+class ClusteringSweep(object):
+    """Cluster labels of one frame at every eps of a grid from a single neighbor search
+
+    The radius graph is built once at the largest eps, every smaller eps keeps
+    the edges no longer than eps. The engines are those of the convoy jobs:
+    dbscan runs sklearn DBSCAN on the precomputed euclidean graph, periodic and
+    periodic_dbscan run RadiusGraphClustering on the periodic graph.
+
+    Attributes:
+        eps_values (list): The eps grid
+        engine (str): 'dbscan', 'periodic' or 'periodic_dbscan'
+        min_samples (int): The DBSCAN core-point threshold of dbscan and periodic_dbscan
+        box: The box dimensions, see box_vectors, unused by dbscan
+        periodic: The axis periodicity, see box_vectors, unused by dbscan
+    """
+    def __init__(self, eps_values, engine='periodic', min_samples=5, box=None, periodic=None):
+        self.eps_values = list(eps_values)
+        self.engine = engine
+        self.min_samples = min_samples
+        self.box = box
+        self.periodic = periodic
+
+    def neighbor_graph(self, X):
+        """ (i, j, distance) Numpy arrays of the point pairs within the largest eps, i < j """
+        if self.engine == 'dbscan':
+            positions, boxsize = X, None
+        else:
+            positions, boxsize = box_positions(X, self.box, self.periodic)
+        pairs = cKDTree(positions, boxsize=boxsize).query_pairs(max(self.eps_values), output_type='ndarray')
+        i, j = pairs[:, 0], pairs[:, 1]
+        if self.engine == 'dbscan':
+            distance = np.linalg.norm(positions[j] - positions[i], axis=-1)
+        else:
+            distance, _ = periodic_distance(positions[i], positions[j], self.box, self.periodic)
+        return i, j, distance
+
+    def fit_predict(self, X, y=None, sample_weight=None):
+        """ List of the cluster labels at every eps, in eps_values order """
+        X = np.asarray(X, dtype=np.float64)
+        size = len(X)
+        if size == 0:
+            return [np.empty(0, dtype=np.int64) for _ in self.eps_values]
+        X = X.reshape(size, -1)
+        i, j, distance = self.neighbor_graph(X)
+
+        labels = []
+        for eps in self.eps_values:
+            keep = distance <= eps
+            if self.engine == 'dbscan':
+                rows, cols = np.concatenate((i[keep], j[keep])), np.concatenate((j[keep], i[keep]))
+                graph = coo_matrix((np.tile(distance[keep], 2), (rows, cols)), shape=(size, size)).tocsr()
+                clf = DBSCAN(eps=eps, min_samples=self.min_samples, metric='precomputed')
+                labels.append(clf.fit_predict(graph, sample_weight=sample_weight))
+            else:
+                min_samples = self.min_samples if self.engine == 'periodic_dbscan' else None
+                clf = RadiusGraphClustering(eps, min_samples=min_samples, box=self.box, periodic=self.periodic)
+                labels.append(clf.graph_labels(i[keep], j[keep], size, sample_weight))
+        return labels
+
+# Clustering engines selectable for convoy jobs
+CLUSTERING_ENGINES = ('dbscan', 'periodic', 'periodic_dbscan')
+
+def get_clusterer(engine, eps, box=BOX_SIZE, periodic=PERIODIC_AXES, min_samples=5):
+    """
+    Build the per-frame clustering engine of a convoy job
+
+    dbscan: sklearn DBSCAN, plain euclidean distance
+    periodic: connected components of the periodic eps-radius graph
+    periodic_dbscan: periodic eps-radius graph with DBSCAN core-point semantics
+    """
+    if engine == 'dbscan':
+        return DBSCAN(eps=eps, min_samples=min_samples)
+    if engine == 'periodic':
+        return RadiusGraphClustering(eps, box=box, periodic=periodic)
+    if engine == 'periodic_dbscan':
+        return RadiusGraphClustering(eps, min_samples=min_samples, box=box, periodic=periodic)
+    raise ValueError(f'Unknown clustering engine {engine}')
+
+class FrameClusters(object):
+    """Cluster memberships of one frame as sorted int arrays
+
+    Attributes:
+        labels (ndarray): The cluster label of every object
+        unique (ndarray): The sorted distinct labels, clusters are referred to by their position in it
+        label_pos (ndarray): The position in unique of every object's label
+        order (ndarray): The object indices grouped by cluster, ascending within a cluster
+        bounds (ndarray): The start of every cluster in order, plus the total count
+        rank (ndarray): The iteration position of every label in a Python set of the labels,
+            the order the set based CMC visited clusters in
+    """
+    __slots__ = ('labels', 'unique', 'label_pos', 'order', 'bounds', 'rank')
+
+    def __init__(self, labels):
+        self.labels = np.asarray(labels)
+        self.unique, self.label_pos, sizes = np.unique(self.labels, return_inverse=True, return_counts=True)
+        self.label_pos = self.label_pos.reshape(-1)
+        self.order = np.argsort(self.label_pos, kind='stable')
+        self.bounds = np.concatenate(([0], np.cumsum(sizes)))
+        self.rank = np.empty(len(self.unique), dtype=np.int64)
+        self.rank[np.searchsorted(self.unique, list(set(self.labels.tolist())))] = np.arange(len(self.unique))
+
+    def members(self, cluster):
+        """ Sorted object indices of a cluster """
+        return self.order[self.bounds[cluster]:self.bounds[cluster + 1]]
+
+    def intersection(self, indices, cluster):
+        """ Sorted indices that belong to a cluster """
+        indices = as_indices(indices)
+        return indices[self.label_pos[indices] == cluster]
+
+    def extend(self, candidates, m):
+        """
+        Match candidates to the clusters holding at least m of their members
 
-    return HB, HBatoms
+        The members' labels of all candidates are counted at once instead of
+        intersecting every candidate with every cluster. A candidate matching
+        several clusters keeps the last one in set order, like the set based
+        intersection loop did.
+
+        Returns
+        -------
+        chosen: Numpy 1D int array, the cluster extending each candidate or -1
+        assigned: Numpy 1D bool array, whether each cluster extends some candidate
+        """
+        clusters = len(self.unique)
+        chosen = np.full(len(candidates), -1, dtype=np.int64)
+        assigned = np.zeros(clusters, dtype=bool)
+
+        members = [as_indices(candidate.indices) for candidate in candidates]
+        sizes = np.fromiter((len(indices) for indices in members), dtype=np.int64, count=len(members))
+        eligible = np.flatnonzero(sizes >= m)
+        if len(eligible) == 0:
+            return chosen, assigned
+
+        flat = np.concatenate([members[i] for i in eligible])
+        owner = np.repeat(eligible, sizes[eligible])
+        keys, counts = np.unique(owner * clusters + self.label_pos[flat], return_counts=True)
+        hit_owner, hit_cluster = np.divmod(keys[counts >= m], clusters)
+        if len(hit_owner) == 0:
+            return chosen, assigned
+        assigned[hit_cluster] = True
+
+        ordered = np.lexsort((self.rank[hit_cluster], hit_owner))
+        hit_owner, hit_cluster = hit_owner[ordered], hit_cluster[ordered]
+        last = np.append(hit_owner[1:] != hit_owner[:-1], True)
+        chosen[hit_owner[last]] = hit_cluster[last]
+        return chosen, assigned
+
+def as_indices(indices):
+    """ Sorted int array of object indices from an array, set or list """
+    if isinstance(indices, np.ndarray):
+        return indices
+    return np.array(sorted(indices), dtype=np.int64)
 
 class ConvoyCandidate(object):
     """
     Attributes:
-        indices(set): The object indices assigned to the convoy
+        indices(ndarray): The sorted object indices assigned to the convoy
         is_assigned (bool):
         start_time (int):  The start index of the convoy
         end_time (int):  The last index of the convoy
@@ -183,61 +765,493 @@ class ConvoyCandidate(object):
             'end_time': self.end_time
         }
     
+class CMCCheckpoint(object):
+    """
+    State of CMC after the last frame of a run, to continue it on later frames
+
+    Attributes:
+        frame (int): The number of processed frames, the first frame to process on resume
+        candidates (list): The live ConvoyCandidate objects after frame - 1
+    """
+    __slots__ = ('frame', 'candidates')
+
+    def __init__(self, frame=0, candidates=()):
+        self.frame = frame
+        self.candidates = list(candidates)
+
+    def __repr__(self):
+        return '<%r frame=%r, candidates=%r>' % (self.__class__.__name__, self.frame, len(self.candidates))
+
+    def closed(self, convoys):
+        """
+        Convoys of the checkpointed run that a longer run yields as well
+
+        The other convoys were only yielded because the run ended at their
+        last frame, a resumed run extends and yields them itself.
+        """
+        return [convoy for convoy in convoys if convoy.end_time < self.frame - 1]
+
+def shared_frames(X):
+    """
+    Share a frames first array with worker processes without pickling it
+
+    Memmaps of a C-contiguous file region are reopened by the workers from the
+    same file, anything else is copied once into a shared memory block.
+
+    Returns
+    -------
+    spec: picklable description of the array for attach_frames
+    shm: the SharedMemory block to close and unlink afterwards, or None
+    """
+    X = X if isinstance(X, np.ndarray) else np.asarray(X)
+    root = X
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    if isinstance(root, np.memmap) and root.filename and X.flags.c_contiguous:
+        offset = root.offset + (X.ctypes.data - root.ctypes.data)
+        return ('memmap', root.filename, offset, X.shape, X.dtype.str), None
+
+    shm = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+    shared = np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)
+    for column in range(len(X)):
+        shared[column] = X[column]
+    return ('shm', shm.name, 0, X.shape, X.dtype.str), shm
+
+def attach_frames(spec):
+    """ Worker side of shared_frames, returns (array, handle to keep alive) """
+    kind, name, offset, shape, dtype = spec
+    if kind == 'memmap':
+        return np.memmap(name, dtype=dtype, mode='r', offset=offset, shape=shape), None
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+_worker_state = {}
+
+def _init_cluster_worker(spec, clf, m, y, sample_weight):
+    frames, handle = attach_frames(spec)
+    _worker_state.update(frames=frames, handle=handle, clf=clf, m=m, y=y, sample_weight=sample_weight)
+
+def _cluster_worker_frame(column):
+    state = _worker_state
+    return timed_cluster_frame(state['clf'], state['frames'], column, state['m'], state['y'], state['sample_weight'])
+
+def cluster_frame(clf, X, column, m, y=None, sample_weight=None):
+    """ Cluster labels of one frame, None when the frame has fewer than m objects """
+    values = CMC.frame_values(X, column)
+    if len(values) < m:
+        return None
+    return clf.fit_predict(values, y=y, sample_weight=sample_weight)
+
+def timed_cluster_frame(clf, X, column, m, y=None, sample_weight=None):
+    """ cluster_frame and its wall time in seconds """
+    start = time.perf_counter()
+    labels = cluster_frame(clf, X, column, m, y, sample_weight)
+    return labels, time.perf_counter() - start
+
+def ordered_map(executor, fn, items, window):
+    """ executor.map with at most window tasks in flight, results in input order """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
 class CMC(object):
     """Coherence Moving Cluster (CMC) algorithm
 
     Attributes:
         k (int):  Min number of consecutive timestamps to be considered a convoy
         m (int):  Min number of elements to be considered a convoy
+        n_jobs (int):  Number of workers clustering frames in parallel, 1 runs in process
+        pool (str):  'process' for a process pool, 'thread' for engines releasing the GIL
+        chunk_size (int):  Frames read at once from array-likes when clustering in process, None reads frame by frame
+        on_frame (callable):  Called by iter_predict after every merged frame with the frame index, its clustering
+            and merge time in seconds, its number of clusters and the number of live candidates after it
     """
-    def __init__(self, clf, k, m):
+    def __init__(self, clf, k, m, n_jobs=1, pool='process', chunk_size=None, on_frame=None):
         self.clf = clf
         self.k = k
         self.m = m
+        self.n_jobs = n_jobs
+        self.pool = pool
+        self.chunk_size = chunk_size
+        self.on_frame = on_frame
+
+    @staticmethod
+    def frame_count(X):
+        """ Number of frames of X, see fit_predict for the accepted layouts """
+        if isinstance(X, (list, tuple)):
+            return len(X[0])
+        return len(X)
+
+    @staticmethod
+    def frame_values(X, column):
+        """
+        Values of all objects at one frame
+
+        Array-likes are frames first and sliced per frame, which is a zero-copy
+        view for ndarrays and memmaps. Nested Python lists keep the original
+        objects x frames layout.
+        """
+        if isinstance(X, (list, tuple)):
+            return [row[column] if isinstance(row[column], (list, set)) else [row[column]] for row in X]
+        values = np.asarray(X[column])
+        return values.reshape(len(values), -1)
+
+    def cluster_frames(self, X, y=None, sample_weight=None, start=0, timed=False):
+        """
+        Cluster labels of every frame from start on, in frame order
+
+        Frames are clustered independently, by n_jobs workers when n_jobs > 1.
+        Process workers read the trajectory through shared_frames. Labels are
+        yielded as they come so the merge can start before all frames are done.
+
+        Yields
+        ------
+        (column, labels) with labels None for skipped frames, with timed
+        (column, labels, seconds) where seconds is the clustering time of the frame
+        """
+        for column, (labels, seconds) in self.timed_cluster_frames(X, y, sample_weight, start):
+            yield (column, labels, seconds) if timed else (column, labels)
+
+    def timed_cluster_frames(self, X, y=None, sample_weight=None, start=0):
+        columns = range(start, self.frame_count(X))
+        if self.n_jobs <= 1 and self.chunk_size and not isinstance(X, (list, tuple)):
+            for first in range(start, columns.stop, self.chunk_size):
+                chunk = np.asarray(X[first:first + self.chunk_size])
+                for offset in range(len(chunk)):
+                    yield first + offset, timed_cluster_frame(self.clf, chunk, offset, self.m, y, sample_weight)
+            return
+
+        if self.n_jobs <= 1:
+            for column in columns:
+                yield column, timed_cluster_frame(self.clf, X, column, self.m, y, sample_weight)
+            return
+
+        window = 4 * self.n_jobs
+        if self.pool == 'thread' or isinstance(X, (list, tuple)):
+            # estimators like DBSCAN keep per-fit state, so each thread task gets its own copy
+            with ThreadPoolExecutor(self.n_jobs) as executor:
+                labels = ordered_map(executor, lambda column: timed_cluster_frame(copy.copy(self.clf), X, column, self.m, y, sample_weight), columns, window)
+                yield from zip(columns, labels)
+            return
+
+        # only the frames still to cluster are shared
+        spec, shm = shared_frames(X[start:])
+        try:
+            with ProcessPoolExecutor(self.n_jobs, initializer=_init_cluster_worker, initargs=(spec, self.clf, self.m, y, sample_weight)) as executor:
+                yield from zip(columns, ordered_map(executor, _cluster_worker_frame, range(len(columns)), window))
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
 
     def fit_predict(self, X, y=None, sample_weight=None):
+        """
+        Parameters
+        ----------
+        X : array-like of shape (frames, objects, dims), e.g. a (frames, atoms, 3)
+            ndarray or memmap, or nested lists of shape (objects, frames, dims)
+
+        Returns
+        -------
+        list of ConvoyCandidate
+        """
+        return list(self.iter_predict(X, y=y, sample_weight=sample_weight))
+
+    def merge_frame(self, convoy_candidates, frame, column, last=False):
+        """
+        Extend the live convoy candidates with the clusters of one frame
+
+        Parameters
+        ----------
+        convoy_candidates : set of the live ConvoyCandidate
+        frame : FrameClusters of the frame
+        column : index of the frame
+        last : whether it is the last frame, all qualifying candidates are then convoys
+
+        Returns
+        -------
+        (set of the live candidates after the frame, list of the convoys it yields)
+        """
+        current_convoy_candidates = set()
+        convoys = []
+        candidates = list(convoy_candidates)
+        chosen, assigned = frame.extend(candidates, self.m)
+
+        # update existing convoys
+        for convoy_candidate, cluster in zip(candidates, chosen):
+            convoy_candidate.is_assigned = bool(cluster >= 0)
+            if convoy_candidate.is_assigned:
+                convoy_candidate.indices = frame.intersection(convoy_candidate.indices, cluster)
+                current_convoy_candidates.add(convoy_candidate)
+                convoy_candidate.end_time = column
+
+            # check if candidates qualify as convoys
+            candidate_life_time = (convoy_candidate.end_time - convoy_candidate.start_time) + 1
+            if (not convoy_candidate.is_assigned or last) and candidate_life_time >= self.k:
+                convoys.append(convoy_candidate)
+
+        # create new candidates
+        for cluster in np.flatnonzero(~assigned):
+            current_convoy_candidates.add(ConvoyCandidate(indices=frame.members(cluster), is_assigned=False, start_time=column, end_time=column))
+        return current_convoy_candidates, convoys
+
+    def iter_predict(self, X, y=None, sample_weight=None, checkpoint=None):
+        """
+        Streaming form of fit_predict
+
+        Only the live candidates are kept in memory, each convoy is yielded as
+        soon as it closes (is not extended and lived at least k frames), and the
+        convoys still open at the last frame are yielded at the end.
+
+        Parameters
+        ----------
+        checkpoint : CMCCheckpoint, optional
+            A run on the first checkpoint.frame frames of X. Only the later
+            frames are processed, and the checkpoint is updated to the end of
+            X once all convoys are yielded. Together with checkpoint.closed of
+            the earlier convoys the output is that of a run on all of X.
+
+        Yields
+        ------
+        ConvoyCandidate, in the same order as fit_predict returns them
+        """
+        start = 0 if checkpoint is None else checkpoint.frame
         convoy_candidates = set()
-        columns = len(X[0])
+        if checkpoint is not None:
+            # candidates are updated in place, keep the checkpoint intact until the run completes
+            convoy_candidates = {ConvoyCandidate(c.indices, c.is_assigned, c.start_time, c.end_time) for c in checkpoint.candidates}
+        columns = self.frame_count(X)
         column_iterator = range(columns)
-        output_convoys = []
 
-        for column in column_iterator:
-            current_convoy_candidates = set()
-            values = [row[column] if isinstance(row[column], (list, set)) else [row[column]] for row in X]
-            if len(values) < self.m:
+        for column, clusters, cluster_seconds in self.cluster_frames(X, y, sample_weight, start, timed=True):
+            if clusters is None:
+                continue
+            merge_start = time.perf_counter()
+            frame = FrameClusters(clusters)
+            convoy_candidates, convoys = self.merge_frame(convoy_candidates, frame, column, column == column_iterator[-1])
+            if self.on_frame is not None:
+                self.on_frame(column, cluster_seconds, time.perf_counter() - merge_start, int(np.count_nonzero(frame.unique >= 0)), len(convoy_candidates))
+            yield from convoys
+
+        if checkpoint is not None:
+            checkpoint.frame = max(columns, start)
+            checkpoint.candidates = list(convoy_candidates)
+
+    def predict_shard(self, X, start=0, final=True, y=None, sample_weight=None):
+        """
+        Map step of the time-sharded CMC: a run from no candidates on the
+        frames start, ..., len(X) - 1
+
+        Parameters
+        ----------
+        X : see fit_predict, the frames after the shard are left out
+        start : first frame of the shard
+        final : whether the shard ends the trajectory. Otherwise its last
+            frame is not the last one, open candidates are returned instead
+            of yielded as convoys.
+
+        Returns
+        -------
+        (list of the convoys, list of the live ConvoyCandidate after the last frame)
+        """
+        convoy_candidates = set()
+        convoys = []
+        last_column = self.frame_count(X) - 1
+        for column, clusters in self.cluster_frames(X, y, sample_weight, start):
+            if clusters is None:
+                continue
+            convoy_candidates, closed = self.merge_frame(convoy_candidates, FrameClusters(clusters), column, final and column == last_column)
+            convoys.extend(closed)
+        return convoys, list(convoy_candidates)
+
+    def stitch_shard(self, X, candidates, convoys, shard_candidates, start=0, final=True, y=None, sample_weight=None):
+        """
+        Join a shard run of predict_shard to the candidates live before the shard
+
+        Both the single pass, continuing the given candidates, and the shard
+        run are replayed from the first frame of the shard until they hold
+        the same candidates (see joined_starts). From then on both runs make
+        the same choices, so the rest of the shard run is that of the single
+        pass once its candidates carry their earlier start times. Usually only
+        a few frames past the boundary are replayed, a shard where the runs
+        never agree is replayed in full.
+
+        Parameters
+        ----------
+        X : see predict_shard
+        candidates : the single pass candidates live before frame start
+        convoys, shard_candidates : the output of predict_shard for the shard
+        start, final : see predict_shard
+
+        Returns
+        -------
+        (list of the convoys, list of the live ConvoyCandidate after the last frame) of the single pass
+        """
+        if not candidates:
+            return convoys, shard_candidates
+
+        # candidates are updated in place, keep the given ones intact
+        single = {ConvoyCandidate(c.indices, c.is_assigned, c.start_time, c.end_time) for c in candidates}
+        shard = set()
+        stitched = []
+        last_column = self.frame_count(X) - 1
+        for column, clusters in self.cluster_frames(X, y, sample_weight, start):
+            if clusters is None:
+                continue
+            frame = FrameClusters(clusters)
+            last = final and column == last_column
+            single, closed = self.merge_frame(single, frame, column, last)
+            stitched.extend(closed)
+            shard, _ = self.merge_frame(shard, frame, column, last)
+            if last:
+                break
+
+            starts = joined_starts(single, shard, column, self.k)
+            if starts is None:
+                continue
+            # the shard run closes the remaining convoys after column
+            def join(candidate):
+                if candidate.start_time <= column:
+                    candidate.start_time = starts.get((candidate.start_time, int(candidate.indices[0])), candidate.start_time)
+                return candidate
+            stitched.extend(join(convoy) for convoy in convoys if convoy.end_time >= column)
+            return stitched, [join(candidate) for candidate in shard_candidates]
+        return stitched, list(single)
+
+    def stitch_shards(self, X, shards, y=None, sample_weight=None):
+        """
+        Reduce step of the time-sharded CMC
+
+        Parameters
+        ----------
+        X : see fit_predict
+        shards : (start, stop, convoys, candidates) of every shard in frame
+            order, convoys and candidates from predict_shard on X[:stop]
+
+        Returns
+        -------
+        (list of the convoys ordered by last frame, list of the live
+        ConvoyCandidate after the last frame), the convoys of fit_predict
+        """
+        convoys = []
+        candidates = []
+        for shard, (start, stop, shard_convoys, shard_candidates) in enumerate(shards):
+            final = shard == len(shards) - 1
+            closed, candidates = self.stitch_shard(X[:stop], candidates, shard_convoys, shard_candidates, start, final, y, sample_weight)
+            convoys.extend(closed)
+        convoys.sort(key=lambda convoy: (convoy.end_time, convoy.start_time))
+        return convoys, candidates
+
+def shard_bounds(frames, shards):
+    """ (start, stop) frame ranges of at most shards equal shards of frames """
+    bounds = np.linspace(0, frames, max(1, min(shards, frames)) + 1).round().astype(int)
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+def joined_starts(single, shard, column, k):
+    """
+    Start times of the single pass for the candidates of a shard run
+
+    Candidates evolve by their members alone, so once both runs hold
+    candidates of the same members they evolve alike, only the start times
+    differ. A pair of candidates with different start times is awaited until
+    both lived k frames, until then only one of them may close as a convoy.
+
+    Parameters
+    ----------
+    single, shard : the live candidates of both runs after frame column
+    column : the frame
+    k : the CMC k
+
+    Returns
+    -------
+    None while the runs differ, otherwise dict of (shard start time, member)
+    to the single pass start time of every member of the shard candidates
+    """
+    if len(single) != len(shard):
+        return None
+    groups = {}
+    for side, candidates in enumerate((single, shard)):
+        for candidate in candidates:
+            key = np.asarray(candidate.indices, dtype=np.int64).tobytes()
+            groups.setdefault(key, ([], [], candidate.indices))[side].append(candidate.start_time)
+
+    starts = {}
+    for singleStarts, shardStarts, indices in groups.values():
+        if len(singleStarts) != len(shardStarts):
+            return None
+        for singleStart, shardStart in zip(sorted(singleStarts), sorted(shardStarts)):
+            if singleStart == shardStart:
                 continue
-            clusters = self.clf.fit_predict(values, y=y, sample_weight=sample_weight)
-            unique_clusters = set(clusters)
-            clusters_indices = dict((cluster, ConvoyCandidate(indices=set(), is_assigned=False, start_time=None, end_time=None)) for cluster in unique_clusters)
-
-            for index, cluster_assignment in enumerate(clusters):
-                clusters_indices[cluster_assignment].indices.add(index)
-
-            # update existing convoys
-            for convoy_candidate in convoy_candidates:
-                convoy_candidate_indices = convoy_candidate.indices
-                convoy_candidate.is_assigned = False
-                for cluster in unique_clusters:
-                    cluster_indices = clusters_indices[cluster].indices
-                    cluster_candidate_intersection = cluster_indices & convoy_candidate_indices
-                    if len(cluster_candidate_intersection) < self.m:
-                        continue
-                    convoy_candidate.indices = cluster_candidate_intersection
-                    current_convoy_candidates.add(convoy_candidate)
-                    convoy_candidate.end_time = column
-                    clusters_indices[cluster].is_assigned = convoy_candidate.is_assigned = True
-
-                # check if candidates qualify as convoys
-                candidate_life_time = (convoy_candidate.end_time - convoy_candidate.start_time) + 1
-                if (not convoy_candidate.is_assigned or column == column_iterator[-1]) and candidate_life_time >= self.k:
-                    output_convoys.append(convoy_candidate)
-
-            # create new candidates
-            for cluster in unique_clusters:
-                cluster_data = clusters_indices[cluster]
-                if cluster_data.is_assigned:
+            if column - max(singleStart, shardStart) + 1 < k:
+                return None
+            starts.update(((shardStart, member), singleStart) for member in np.asarray(indices).tolist())
+    return starts
+
+def sweep_convoys(X, sweep, k_values, m_values, n_jobs=1, pool='process', chunk_size=None, progress=None):
+    """
+    Convoy statistics of every (eps, k, m) point of a parameter grid
+
+    Every frame is clustered once for the whole eps grid by sweep, the labels
+    of each eps are merged once per m. k only decides which of the closing
+    candidates count as convoys, so all k share that merge.
+
+    Parameters
+    ----------
+    X : array-like of frames, see CMC.fit_predict
+    sweep : ClusteringSweep
+    k_values, m_values : the k and m grids
+    n_jobs, pool, chunk_size : how frames are clustered, see CMC
+    progress : optional callable, called with the index of every merged frame
+
+    Returns
+    -------
+    list of dict with eps, k, m, convoys (count), mean_size, max_size,
+    mean_length and max_length (in frames), one per grid point
+    """
+    k_values, m_values = sorted(set(k_values)), sorted(set(m_values))
+    clustering = CMC(sweep, k=k_values[0], m=0, n_jobs=n_jobs, pool=pool, chunk_size=chunk_size)
+    mergers = {m: CMC(None, k=k_values[0], m=m) for m in m_values}
+    candidates = {(e, m): set() for e in range(len(sweep.eps_values)) for m in m_values}
+    # count, size sum, max size, length sum, max length
+    stats = {(e, k, m): [0, 0, 0, 0, 0] for e in range(len(sweep.eps_values)) for k in k_values for m in m_values}
+    last = CMC.frame_count(X) - 1
+
+    for column, labels in clustering.cluster_frames(X):
+        for e, eps_labels in enumerate(labels):
+            frame = FrameClusters(eps_labels)
+            for m in m_values:
+                if len(eps_labels) < m:
                     continue
-                cluster_data.start_time = cluster_data.end_time = column
-                current_convoy_candidates.add(cluster_data)
-            convoy_candidates = current_convoy_candidates
-        return output_convoys
\ No newline at end of file
+                candidates[e, m], convoys = mergers[m].merge_frame(candidates[e, m], frame, column, column == last)
+                for convoy in convoys:
+                    size, length = len(convoy.indices), convoy.end_time - convoy.start_time + 1
+                    for k in k_values:
+                        if length < k:
+                            break
+                        entry = stats[e, k, m]
+                        entry[0] += 1
+                        entry[1] += size
+                        entry[2] = max(entry[2], size)
+                        entry[3] += length
+                        entry[4] = max(entry[4], length)
+        if progress is not None:
+            progress(column)
+
+    table = []
+    for e, eps in enumerate(sweep.eps_values):
+        for k in k_values:
+            for m in m_values:
+                count, size_sum, max_size, length_sum, max_length = stats[e, k, m]
+                table.append({
+                    'eps': eps, 'k': k, 'm': m,
+                    'convoys': count,
+                    'mean_size': size_sum / count if count else 0.0,
+                    'max_size': max_size,
+                    'mean_length': length_sum / count if count else 0.0,
+                    'max_length': max_length
+                })
+    return table
@@ -0,0 +1,117 @@
+import os, glob, json, hashlib, threading
+from collections import OrderedDict
+
+from .results import RESULTS_DIR, evict_files
+
+FIGURE_DIR = f'{RESULTS_DIR}/figures'
+
+# Total size of the figures kept on disk and in the memory of every web process
+FIGURE_DISK_BYTES = int(os.environ.get("FIGURE_CACHE_BYTES", 1024 ** 3))
+FIGURE_MEMORY_BYTES = int(os.environ.get("FIGURE_MEMORY_BYTES", 256 * 1024 ** 2))
+
+# Bump when the plot generators change their output
+FIGURE_VERSION = 2
+
+def figure_key(job_id, plot, convoy_index=None, **settings):
+    """
+    Cache key of a figure
+
+    Figures only depend on finished, immutable job results, so the job id,
+    plot type, convoy index and decimation settings identify them.
+    """
+    params = json.dumps([FIGURE_VERSION, job_id, plot, convoy_index, settings], sort_keys=True)
+    return hashlib.sha256(params.encode()).hexdigest()
+
+def figure_path(key):
+    return f'{FIGURE_DIR}/{key}.json'
+
+class FigureCache(object):
+    """Two tier LRU cache of serialized figures
+
+    Figures are kept in process memory up to memory_bytes and on disk, shared
+    by all processes, up to disk_bytes. Concurrent requests for a missing
+    figure build it once per process.
+
+    Attributes:
+        memory_bytes (int): The size limit of the memory tier
+        disk_bytes (int): The size limit of the disk tier
+    """
+    def __init__(self, memory_bytes=FIGURE_MEMORY_BYTES, disk_bytes=FIGURE_DISK_BYTES):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.building = {}
+
+    def get(self, key, build):
+        """
+        The figure of key, from memory, disk or build()
+
+        Parameters
+        ----------
+        key : figure_key of the figure
+        build : callable returning the serialized figure as a str
+        """
+        payload = self.lookup(key)
+        if payload is not None:
+            return payload
+
+        with self.lock:
+            keyLock = self.building.setdefault(key, threading.Lock())
+        with keyLock:
+            # another request may have built it meanwhile
+            payload = self.lookup(key)
+            if payload is None:
+                payload = build().encode()
+                self.store_disk(key, payload)
+                self.store_memory(key, payload)
+        with self.lock:
+            self.building.pop(key, None)
+        return payload
+
+    def lookup(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        try:
+            with open(figure_path(key), 'rb') as file:
+                payload = file.read()
+        except FileNotFoundError:
+            return None
+        # the modification time orders disk entries for eviction
+        os.utime(figure_path(key))
+        self.store_memory(key, payload)
+        return payload
+
+    def store_memory(self, key, payload):
+        if len(payload) > self.memory_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = payload
+            self.size += len(payload)
+            while self.size > self.memory_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def store_disk(self, key, payload):
+        os.makedirs(FIGURE_DIR, exist_ok=True)
+        tmpPath = f'{figure_path(key)}.{os.getpid()}.tmp'
+        with open(tmpPath, 'wb') as file:
+            file.write(payload)
+        os.replace(tmpPath, figure_path(key))
+        evict_files(glob.glob(f'{FIGURE_DIR}/*.json'), self.disk_bytes)
+
+    def clear(self):
+        """ Drop all figures from both tiers """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        for path in glob.glob(f'{FIGURE_DIR}/*.json'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,218 @@
+import os, json, glob, time, atexit, socket, threading
+from contextlib import contextmanager
+
+# Every web and worker process writes its metrics here, the /metrics endpoint merges them
+METRICS_DIR = os.environ.get("METRICS_DIR", '/usr/src/app/metrics')
+
+# Seconds between snapshots of a process, tasks write one when they finish
+FLUSH_INTERVAL = 10
+
+# Seconds after which the snapshot of a process on another host counts as left behind
+SNAPSHOT_TTL = int(os.environ.get("METRICS_SNAPSHOT_TTL", 24 * 3600))
+
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+FRAME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'task_stage_seconds': ('histogram', 'Wall time of one stage of a task', STAGE_BUCKETS),
+    'cluster_frame_seconds': ('histogram', 'Clustering time of one frame', FRAME_BUCKETS),
+    'merge_frame_seconds': ('histogram', 'CMC merge time of one frame', FRAME_BUCKETS),
+    'task_peak_rss_bytes': ('gauge', 'Peak resident set size of the worker process during one run of a task, highest of all runs', None),
+    'task_frames_total': ('counter', 'Frames processed', None),
+    'task_atoms_total': ('counter', 'Atoms processed, summed over frames', None),
+    'cmc_clusters_total': ('counter', 'Clusters of all frames merged by CMC', None),
+    'cmc_candidates_total': ('counter', 'Live convoy candidates after every CMC frame', None),
+    'task_runs_total': ('counter', 'Finished tasks by final state', None),
+}
+
+class Registry(object):
+    """Metric values of this process
+
+    Attributes:
+        values (dict): metric name to {label key: value}, histogram values are
+            {'buckets': per bucket counts with +Inf last, 'sum', 'count'}
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.values = {name: {} for name in METRICS}
+        self.last_flush = time.monotonic()
+
+    @staticmethod
+    def label_key(labels):
+        return json.dumps(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            entries = self.values[name]
+            key = self.label_key(labels)
+            entries[key] = entries.get(key, 0) + value
+        self.maybe_flush()
+
+    def set_max(self, name, value, **labels):
+        with self.lock:
+            entries = self.values[name]
+            key = self.label_key(labels)
+            entries[key] = max(entries.get(key, value), value)
+        self.maybe_flush()
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        with self.lock:
+            entries = self.values[name]
+            entry = entries.setdefault(self.label_key(labels), {'buckets': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0})
+            entry['buckets'][next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """ Write the snapshot of this process atomically """
+        with self.lock:
+            snapshot = json.dumps(self.values)
+            self.last_flush = time.monotonic()
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = snapshot_path()
+        with open(path + '.tmp', 'w') as file:
+            file.write(snapshot)
+        os.replace(path + '.tmp', path)
+
+def snapshot_path(pid=None):
+    return f'{METRICS_DIR}/{socket.gethostname()}-{pid or os.getpid()}.json'
+
+def remove_snapshot():
+    """ Drop the snapshot of this process when it exits """
+    try:
+        os.remove(snapshot_path())
+    except FileNotFoundError:
+        pass
+
+registry = Registry()
+# forked workers start empty instead of repeating the values of their parent
+os.register_at_fork(after_in_child=registry.reset)
+# forked pool processes leave through os._exit, the workers remove theirs on worker_process_shutdown
+atexit.register(remove_snapshot)
+
+inc = registry.inc
+set_max = registry.set_max
+observe = registry.observe
+flush = registry.flush
+
+@contextmanager
+def stage(task, name):
+    """ Record the wall time of a block as stage name of task """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('task_stage_seconds', time.perf_counter() - start, task=task, stage=name)
+
+def reset_peak_rss():
+    """ Restart the peak RSS (VmHWM) of this process at its current RSS, Linux only """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+def peak_rss():
+    """ Peak RSS in bytes of this process since it started or since reset_peak_rss, None without /proc """
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def record_peak_rss(task):
+    """ Record the peak RSS of this process since reset_peak_rss, called before the task ran """
+    peak = peak_rss()
+    if peak is not None:
+        set_max('task_peak_rss_bytes', peak, task=task)
+
+def snapshot_alive(path):
+    """
+    Whether the snapshot at path belongs to a running process
+
+    Processes of this host are looked up by pid, snapshots of other hosts
+    count until SNAPSHOT_TTL after their last write.
+    """
+    host, _, pid = os.path.basename(path)[:-len('.json')].rpartition('-')
+    if host == socket.gethostname() and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    return time.time() - os.path.getmtime(path) < SNAPSHOT_TTL
+
+def merged_values():
+    """
+    Metric values of all process snapshots, counters and histograms summed,
+    gauges at their highest. Snapshots of exited processes are removed.
+    """
+    merged = {name: {} for name in METRICS}
+    for path in glob.glob(f'{METRICS_DIR}/*.json'):
+        try:
+            if not snapshot_alive(path):
+                os.remove(path)
+                continue
+            with open(path) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            continue
+        for name, entries in snapshot.items():
+            if name not in METRICS:
+                continue
+            kind = METRICS[name][0]
+            for key, value in entries.items():
+                if key not in merged[name]:
+                    merged[name][key] = json.loads(json.dumps(value))
+                elif kind == 'counter':
+                    merged[name][key] += value
+                elif kind == 'gauge':
+                    merged[name][key] = max(merged[name][key], value)
+                else:
+                    entry = merged[name][key]
+                    entry['buckets'] = [a + b for a, b in zip(entry['buckets'], value['buckets'])]
+                    entry['sum'] += value['sum']
+                    entry['count'] += value['count']
+    return merged
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in pairs) + '}'
+
+def render():
+    """ All metrics in the Prometheus text exposition format """
+    flush()
+    lines = []
+    for name, entries in merged_values().items():
+        kind, help, buckets = METRICS[name]
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+        for key, value in sorted(entries.items()):
+            labels = json.loads(key)
+            if kind != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], value['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {value["sum"]}')
+            lines.append(f'{name}_count{format_labels(labels)} {value["count"]}')
+    return '\n'.join(lines) + '\n'
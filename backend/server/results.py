@@ -0,0 +1,437 @@
+import os, glob, json, time, hashlib, pickle, shutil, struct, zipfile
+import numpy as np
+
+from .algorithms import ALGORITHM_VERSION, ConvoyCandidate, as_indices
+
+RESULTS_DIR = '/usr/src/app/results'
+CACHE_DIR = f'{RESULTS_DIR}/cache'
+
+# Total size of cached convoy results before the least recently used ones are evicted
+CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_BYTES", 2 * 1024 ** 3))
+
+# Seconds an in-flight marker counts, older markers belong to lost jobs
+INFLIGHT_TTL = int(os.environ.get("INFLIGHT_TTL", 6 * 3600))
+
+def convoy_result_path(job_id):
+    return f'{RESULTS_DIR}/{job_id}.convoys.npz'
+
+def convoy_stream_path(job_id):
+    return f'{RESULTS_DIR}/{job_id}.convoys.part'
+
+def hbond_result_path(job_id):
+    return f'{RESULTS_DIR}/{job_id}.hbonds.npz'
+
+def shard_convoys_path(job_id):
+    return f'{RESULTS_DIR}/{job_id}.shard.convoys.npz'
+
+def shard_candidates_path(job_id):
+    return f'{RESULTS_DIR}/{job_id}.shard.open.npz'
+
+def index_dtype(values):
+    """ Smallest of int32 and int64 holding the values """
+    return np.int32 if len(values) == 0 or np.max(values) < 2 ** 31 else np.int64
+
+def save_arrays(path, **arrays):
+    """ Write an uncompressed .npz atomically """
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(tmpPath, path)
+
+def read_convoy_stream(path):
+    """Convoys pickled one after another while a convoy job runs, in emission order"""
+    convoys = []
+    with open(path, 'rb') as file:
+        while True:
+            try:
+                convoys.append(pickle.load(file))
+            except EOFError:
+                return convoys
+
+def write_convoy_file(path, convoys):
+    """
+    Store convoys as a columnar .npz
+
+    indices holds the member indices of all convoys back to back, the members
+    of convoy c are indices[offsets[c]:offsets[c + 1]]. start_time, end_time
+    and is_assigned have one entry per convoy.
+    """
+    sizes = [len(convoy.indices) for convoy in convoys]
+    indices = np.concatenate([np.asarray(convoy.indices) for convoy in convoys]) if convoys else np.empty(0, dtype=np.int64)
+    save_arrays(path,
+                indices=indices.astype(index_dtype(indices)),
+                offsets=np.concatenate(([0], np.cumsum(sizes))).astype(np.int64),
+                start_time=np.array([convoy.start_time for convoy in convoys], dtype=np.int64),
+                end_time=np.array([convoy.end_time for convoy in convoys], dtype=np.int64),
+                is_assigned=np.array([convoy.is_assigned for convoy in convoys], dtype=bool))
+
+def read_convoy_file(path):
+    """Convoys stored by write_convoy_file, in emission order"""
+    with np.load(path) as table:
+        indices, offsets = table['indices'].astype(np.int64), table['offsets']
+        return [ConvoyCandidate(indices[offsets[c]:offsets[c + 1]], bool(assigned), int(start), int(end))
+                for c, (start, end, assigned) in enumerate(zip(table['start_time'], table['end_time'], table['is_assigned']))]
+
+def open_npz_array(path, name):
+    """
+    Read-only memmap of one array of an uncompressed .npz
+
+    np.load reads a whole .npz member on access, mapping it reads only the
+    pages that are indexed.
+    """
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(f'{name}.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        with np.load(path) as table:
+            return table[name]
+
+    with open(path, 'rb') as file:
+        # the local file header is 30 bytes plus the file name and extra field
+        file.seek(info.header_offset + 26)
+        nameLength, extraLength = struct.unpack('<HH', file.read(4))
+        file.seek(info.header_offset + 30 + nameLength + extraLength)
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(file)
+        offset = file.tell()
+    if np.prod(shape) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran else 'C')
+
+class ConvoyTable(object):
+    """Columns of a convoy result, member indices are only read for the convoys asked for
+
+    Attributes:
+        indices (ndarray): The member indices of all convoys back to back
+        offsets (ndarray): The start of every convoy in indices, plus the total count
+        start_time (ndarray): The start frame of every convoy
+        end_time (ndarray): The last frame of every convoy
+    """
+    # sort keys and filter fields of query
+    COLUMNS = ('size', 'length', 'start', 'end')
+
+    def __init__(self, indices, offsets, start_time, end_time):
+        self.indices = indices
+        self.offsets = np.asarray(offsets)
+        self.start_time = np.asarray(start_time)
+        self.end_time = np.asarray(end_time)
+
+    @classmethod
+    def open(cls, path):
+        """ Table of a write_convoy_file result, indices stay on disk """
+        return cls(*(open_npz_array(path, name) for name in ('indices', 'offsets', 'start_time', 'end_time')))
+
+    @classmethod
+    def from_convoys(cls, convoys):
+        # pickled results of older jobs hold the members as a set
+        members = [as_indices(convoy.indices) for convoy in convoys]
+        sizes = [len(indices) for indices in members]
+        indices = np.concatenate(members) if convoys else np.empty(0, dtype=np.int64)
+        return cls(indices, np.concatenate(([0], np.cumsum(sizes))),
+                   [convoy.start_time for convoy in convoys], [convoy.end_time for convoy in convoys])
+
+    def __len__(self):
+        return len(self.start_time)
+
+    def column(self, name):
+        if name == 'size':
+            return np.diff(self.offsets)
+        if name == 'length':
+            return self.end_time - self.start_time + 1
+        if name == 'start':
+            return self.start_time
+        if name == 'end':
+            return self.end_time
+        raise ValueError(f'Unknown convoy column {name}')
+
+    def query(self, filters=None, sort=None, descending=False):
+        """
+        Positions of the convoys passing the filters, in sort order
+
+        Parameters
+        ----------
+        filters : dict of column name to (minimum, maximum), either bound may be None
+        sort : column name, None keeps the emission order
+        descending : reverse the sort order, ties stay in emission order
+        """
+        selected = np.arange(len(self))
+        for name, (low, high) in (filters or {}).items():
+            values = self.column(name)[selected]
+            keep = np.ones(len(selected), dtype=bool)
+            if low is not None:
+                keep &= values >= low
+            if high is not None:
+                keep &= values <= high
+            selected = selected[keep]
+        if sort is not None:
+            values = self.column(sort)[selected]
+            selected = selected[np.argsort(-values if descending else values, kind='stable')]
+        elif descending:
+            selected = selected[::-1]
+        return selected
+
+    def members(self, position):
+        return np.asarray(self.indices[self.offsets[position]:self.offsets[position + 1]])
+
+    def serialize(self, positions, members=False):
+        """ ConvoyCandidate.serialize of the convoys at positions, with their position as index """
+        rows = []
+        for position in np.asarray(positions).tolist():
+            row = {
+                'index': position,
+                'num_of_indices': int(self.offsets[position + 1] - self.offsets[position]),
+                'start_time': int(self.start_time[position]),
+                'end_time': int(self.end_time[position])
+            }
+            if members:
+                row['indices'] = self.members(position).tolist()
+            rows.append(row)
+        return rows
+
+def read_convoys(job_id):
+    """Convoys persisted by a convoy job, in emission order"""
+    return read_convoy_file(convoy_result_path(job_id))
+
+def convoy_summary(convoys):
+    """ What a convoy job returns to the result backend, the convoys stay in its result file """
+    sizes = [len(convoy.indices) for convoy in convoys]
+    lengths = [convoy.end_time - convoy.start_time + 1 for convoy in convoys]
+    return {
+        'kind': 'convoys',
+        'convoys': len(convoys),
+        'max_size': max(sizes, default=0),
+        'max_length': max(lengths, default=0)
+    }
+
+def write_hbond_file(path, hbonds, start_frame):
+    """
+    Store the hydrogen bonds of frames start_frame, ... as a columnar .npz
+
+    triples holds the [hn, n, o] rows of all frames back to back, the bonds of
+    frame start_frame + f are triples[offsets[f]:offsets[f + 1]].
+    """
+    frames = hbonds[start_frame:]
+    triples = np.array([bond for bonds in frames for bond in bonds], dtype=np.int64).reshape(-1, 3)
+    save_arrays(path,
+                triples=triples.astype(index_dtype(triples)),
+                offsets=np.concatenate(([0], np.cumsum([len(bonds) for bonds in frames]))).astype(np.int64),
+                start_frame=np.int64(start_frame))
+
+def read_hbond_file(path):
+    """Hydrogen bonds stored by write_hbond_file as a list of [hn, n, o] lists per frame from frame 0"""
+    with np.load(path) as table:
+        triples, offsets = table['triples'].tolist(), table['offsets']
+        start_frame = int(table['start_frame'])
+    return [[] for _ in range(start_frame)] + [triples[offsets[f]:offsets[f + 1]] for f in range(len(offsets) - 1)]
+
+def hbond_summary(hbonds, start_frame):
+    """ What a hydrogen bond job returns to the result backend """
+    return {
+        'kind': 'hbonds',
+        'frames': len(hbonds) - start_frame,
+        'bonds': sum(len(bonds) for bonds in hbonds)
+    }
+
+def job_convoys(job):
+    """Convoys of a finished convoy job, from its result file or a pickled result of older jobs"""
+    if isinstance(job.result, bytes):
+        # older jobs hold the members as a set
+        convoys = pickle.loads(job.result)
+        for convoy in convoys:
+            convoy.indices = as_indices(convoy.indices)
+        return convoys
+    return read_convoys(job.id)
+
+def job_convoy_table(job):
+    """ConvoyTable of a finished convoy job, see job_convoys"""
+    if isinstance(job.result, bytes):
+        return ConvoyTable.from_convoys(pickle.loads(job.result))
+    return ConvoyTable.open(convoy_result_path(job.id))
+
+def job_convoy_members(job, position):
+    """
+    Member indices of one convoy of a finished convoy job, only its members are read
+
+    Raises IndexError when the job has no convoy at position.
+    """
+    table = job_convoy_table(job)
+    if not 0 <= position < len(table):
+        raise IndexError(f'Convoy {position} out of range, the job found {len(table)} convoys')
+    return table.members(position).astype(np.int64)
+
+def job_hbonds(job):
+    """Hydrogen bonds per frame of a finished hydrogen bond job, see job_convoys"""
+    if isinstance(job.result, bytes):
+        return pickle.loads(job.result)
+    return read_hbond_file(hbond_result_path(job.id))
+
+def cache_key(content_hash, k, m, eps, end, engine):
+    """
+    Cache key of a convoy job, None when the dataset content is unknown
+
+    The dataset content hash prefixes the key so that all entries of a dataset
+    can be invalidated together.
+    """
+    if not content_hash:
+        return None
+    params = json.dumps([ALGORITHM_VERSION, k, m, float(eps), end, engine])
+    return f'{content_hash}-{hashlib.sha256(params.encode()).hexdigest()[:32]}'
+
+def cache_path(key):
+    return f'{CACHE_DIR}/{key}.convoys.npz'
+
+def inflight_path(key):
+    return f'{CACHE_DIR}/{key}.inflight'
+
+def checkpoint_path(key):
+    return f'{CACHE_DIR}/{key}.checkpoint'
+
+def cache_lookup(key):
+    """
+    How a convoy job with this cache key can be served
+
+    Returns
+    -------
+    ('hit', None) when the result is cached, ('inflight', job_id) when an
+    identical job is computing it, (None, None) otherwise. Markers older than
+    INFLIGHT_TTL are ignored.
+    """
+    if key is None:
+        return None, None
+    if os.path.exists(cache_path(key)):
+        return 'hit', None
+    try:
+        if time.time() - os.path.getmtime(inflight_path(key)) < INFLIGHT_TTL:
+            with open(inflight_path(key)) as file:
+                return 'inflight', file.read().strip()
+    except FileNotFoundError:
+        pass
+    return None, None
+
+def mark_inflight(key, job_id):
+    """Mark job_id as computing the result of key, marking again renews the marker"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(inflight_path(key), 'w') as file:
+        file.write(job_id)
+
+def clear_inflight(key, job_id):
+    """Drop the in-flight marker of a key if job_id still owns it"""
+    try:
+        with open(inflight_path(key)) as file:
+            if file.read().strip() == job_id:
+                os.remove(inflight_path(key))
+    except FileNotFoundError:
+        pass
+
+def cache_fetch(key, path):
+    """Copy a cached result to path, False when it is not (or no longer) cached"""
+    try:
+        shutil.copyfile(cache_path(key), path)
+    except FileNotFoundError:
+        return False
+    # the modification time orders entries for eviction
+    os.utime(cache_path(key))
+    return True
+
+def cache_store(key, path):
+    """Add the result file at path to the cache, then evict down to CACHE_MAX_BYTES"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmpPath = cache_path(key) + '.tmp'
+    shutil.copyfile(path, tmpPath)
+    os.replace(tmpPath, cache_path(key))
+    cache_evict()
+
+def cache_evict(max_bytes=None):
+    """Delete least recently used entries until the cache holds at most max_bytes"""
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    evict_files(glob.glob(f'{CACHE_DIR}/*.convoys.npz') + glob.glob(f'{CACHE_DIR}/*.checkpoint'), max_bytes)
+
+def evict_files(paths, max_bytes):
+    """Delete the least recently modified of paths until they total at most max_bytes"""
+    entries = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def cache_invalidate(content_hash=None):
+    """
+    Delete cached results and checkpoints of one dataset content, or of every dataset
+
+    Returns
+    -------
+    number of deleted entries
+    """
+    prefix = f'{CACHE_DIR}/{content_hash}-' if content_hash else f'{CACHE_DIR}/'
+    removed = 0
+    for path in glob.glob(f'{prefix}*.convoys.npz') + glob.glob(f'{prefix}*.checkpoint'):
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+def load_checkpoint(key, end):
+    """
+    The stored CMC checkpoint of key if it can be resumed up to frame end
+
+    Returns
+    -------
+    (CMCCheckpoint, list of the convoys closed before it), or (None, []) when
+    there is no checkpoint before end
+    """
+    if key is None:
+        return None, []
+    try:
+        with open(checkpoint_path(key), 'rb') as file:
+            checkpoint = pickle.load(file)
+            if checkpoint.frame >= end:
+                return None, []
+            convoys = []
+            while True:
+                try:
+                    convoys.append(pickle.load(file))
+                except EOFError:
+                    break
+    except FileNotFoundError:
+        return None, []
+    os.utime(checkpoint_path(key))
+    return checkpoint, convoys
+
+def store_checkpoint(key, checkpoint, path):
+    """
+    Store the checkpoint of a run with its result file at path
+
+    Only the convoys the checkpoint closed are kept. An existing checkpoint
+    of later frames is not replaced.
+    """
+    try:
+        with open(checkpoint_path(key), 'rb') as file:
+            if pickle.load(file).frame >= checkpoint.frame:
+                return
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmpPath = checkpoint_path(key) + '.tmp'
+    with open(tmpPath, 'wb') as file:
+        pickle.dump(checkpoint, file)
+        for convoy in checkpoint.closed(read_convoy_file(path)):
+            pickle.dump(convoy, file)
+    os.replace(tmpPath, checkpoint_path(key))
+    cache_evict()
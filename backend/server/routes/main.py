@@ -1,19 +1,26 @@
-from flask import Flask, request, jsonify, Blueprint, abort
+from flask import Flask, request, jsonify, Blueprint, abort, make_response
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from celery import chord, group
 from celery.result import AsyncResult
 from werkzeug.utils import secure_filename
+from werkzeug.http import parse_content_range_header
 import os, datetime, json
 import numpy as np
 import pickle
 
 from ..extensions import db, bcrypt, jwt, cors
 from ..models.models import User, Job, Company, Dataset
-from ..algorithms import ConvoyCandidate
+from ..algorithms import ConvoyCandidate, shard_bounds
 
-from .jobs import convoy_job, hb_detection, celery, generate_hb_plot, generate_convoy_plot, generate_context_plot
+from .. import metrics
+from ..figures import FigureCache, figure_key
+from ..results import ConvoyTable, convoy_summary, cache_key, cache_lookup, cache_invalidate, mark_inflight, job_convoys, job_convoy_table, job_hbonds
+from ..storage import DATA_DIR, dataset_path, remove_dataset_files, describe_dataset, read_metadata
+from ..uploads import UPLOAD_CHUNK_SIZE, UploadError, UploadLocked, lock_upload, create_upload, read_upload, write_chunk, missing_chunks, chunk_count, upload_checksum, finish_upload, remove_upload
+from .jobs import job_states, convoy_job, convoy_shard_job, stitch_convoy_job, clear_convoy_inflight, sweep_job, hb_detection, profile_dataset_job, convert_dataset_job, celery, CLUSTERING_ENGINES, FIGURE_ENCODINGS, generate_hb_plot, generate_convoy_plot, generate_context_plot
 
 # create main blueprint
 main = Blueprint("main", __name__,)
@@ -162,6 +169,10 @@ def password():
     else:
         return jsonify({'message': 'Invalid Email'}), 401
 
+def is_number(value, kind):
+    """True for a value of kind from a JSON body, bools are ints in Python but not numbers here"""
+    return isinstance(value, kind) and not isinstance(value, bool)
+
 @main.route("/job/convoy", methods=["POST"])
 @jwt_required()
 def start_convoy():
@@ -195,6 +206,15 @@ def start_convoy():
                     tpye: int
                     desc: Last frame of convoy to detect
                     required: True
+                engine:
+                    type: string
+                    desc: Clustering engine, dbscan (default), periodic or periodic_dbscan
+                workers:
+                    type: int
+                    desc: Number of processes clustering frames in parallel (default = 1)
+                shards:
+                    type: int
+                    desc: Number of frame ranges detected by parallel jobs and stitched afterwards, same convoys as one job (default = 1)
     responses:
         202:
             description: Success
@@ -204,8 +224,13 @@ def start_convoy():
                     job_id:
                         type: string
                         description: ID of the created job
+                    cached:
+                        type: string
+                        description: hit when the job is served from the result cache, inflight when it waits for an identical running job, null otherwise
         500:
             description: Error
+        400:
+            description: Error k, m, eps or end not positive numbers or invalid for the dataset, unknown clustering engine, invalid worker or shard count
         404:
             description: Error dataset not found
         405:
@@ -224,14 +249,63 @@ def start_convoy():
     user = User.query.filter_by(user_id=get_jwt_identity()).first()
     if user.company_id != dataset.company_id:
         abort(401, "No permissions to use dataset")
+    sync_dataset_stats(dataset)
+
+    k = data.get("k")
+    m = data.get("m")
+    eps = data.get("eps")
+    end = data.get("end") # end frame
+
+    # checked before they reach the cache key and the job
+    for name, value, kind in (('k', k, int), ('m', m, int), ('eps', eps, (int, float)), ('end', end, int)):
+        if not is_number(value, kind) or value <= 0:
+            abort(400, f"{name} must be a positive number")
+
+    # reject jobs the dataset cannot satisfy
+    if dataset.frame_count is not None and not (0 < end <= dataset.frame_count):
+        abort(400, f"End frame must be between 1 and {dataset.frame_count}")
+
+    if dataset.atom_count is not None and m > dataset.atom_count:
+        abort(400, f"Dataset has only {dataset.atom_count} atoms")
+    engine = data.get("engine", "dbscan")
+
+    workers = data.get("workers", 1)
 
-    #TODO: add parameter data validation
-    k = data["k"]
-    m = data["m"]
-    eps = data["eps"]
-    end = data["end"] # end frame
+    if engine not in CLUSTERING_ENGINES:
+        abort(400, "Unknown clustering engine")
 
-    job = convoy_job.delay(filename=dataset.dataset_name, k_in=k, m_in=m, eps_in=eps, end=end)
+    if not is_number(workers, int) or workers < 1:
+        abort(400, "Invalid worker count")
+
+    shards = data.get("shards", 1)
+    if not is_number(shards, int) or shards < 1:
+        abort(400, "Invalid shard count")
+
+    # identical jobs resolve from the result cache or wait for the running one
+    key = cache_key(dataset.content_hash, k, m, eps, end, engine)
+    cached, source_job = cache_lookup(key)
+    workers = min(workers, os.cpu_count() or 1)
+    checkpointKey = cache_key(dataset.content_hash, k, m, eps, None, engine)
+
+    # shard bounds need the frame count, every shard must hold frames
+    if shards > 1 and cached is None and dataset.frame_count is not None:
+        # the stitch job is the job, its filename kwarg is read like convoy_job's
+        shardJobs = group(convoy_shard_job.s(filename=dataset.dataset_name, start=start, stop=stop, final=stop == end, k_in=k, m_in=m, eps_in=eps,
+                                             engine=engine, workers=workers)
+                          for start, stop in shard_bounds(end, shards))
+        stitchJob = stitch_convoy_job.s(filename=dataset.dataset_name, k_in=k, m_in=m, eps_in=eps, end=end, engine=engine,
+                                        workers=workers, cache_key=key, checkpoint_key=checkpointKey)
+        # a failed shard fails the stitch job without running it
+        stitchJob.on_error(clear_convoy_inflight.s(cache_key=key))
+        job = chord(shardJobs)(stitchJob)
+        if key is not None:
+            mark_inflight(key, job.id)
+    else:
+        job = convoy_job.delay(filename=dataset.dataset_name, k_in=k, m_in=m, eps_in=eps, end=end, engine=engine,
+                               workers=workers, cache_key=key, source_job=source_job, checkpoint_key=checkpointKey)
+        # identical jobs submitted while this one is queued wait for it
+        if key is not None and cached is None:
+            mark_inflight(key, job.id)
     
     jobDb = Job(
         job_id = job.id,
@@ -243,8 +317,153 @@ def start_convoy():
     db.session.add(jobDb)
     db.session.commit()
 
+    return jsonify({"job_id": job.id, "cached": cached}), 202
+
+@main.route("/job/sweep", methods=["POST"])
+@jwt_required()
+def start_sweep():
+    """
+    Begin a convoy parameter sweep job over grids of eps, k and m.
+    ---
+    parameters:
+        - name: body
+          in: body
+          required: true
+          schema:
+            id: SweepJobStartData
+            properties:
+                dataset_id:
+                    type: int
+                    desc: ID of dataset for processing
+                    required: True
+                eps:
+                    type: array
+                    desc: Distance parameters for clustering
+                    required: True
+                k:
+                    type: array
+                    desc: Minimum consecutive timesteps values
+                    required: True
+                m:
+                    type: array
+                    desc: Minimum cluster elements values
+                    required: True
+                end:
+                    type: int
+                    desc: Last frame of convoys to detect
+                    required: True
+                engine:
+                    type: string
+                    desc: Clustering engine, dbscan (default), periodic or periodic_dbscan
+                workers:
+                    type: int
+                    desc: Number of processes clustering frames in parallel (default = 1)
+    responses:
+        202:
+            description: Success, the job result lists eps, k, m, convoys, mean_size, max_size, mean_length and max_length per grid point
+            schema:
+                id: CreatedJob
+                properties:
+                    job_id:
+                        type: string
+                        description: ID of the created job
+        400:
+            description: Error invalid parameter grids or end frame, unknown clustering engine or invalid worker count
+        404:
+            description: Error dataset not found
+        401:
+            description: Error no permissions to dataset
+    """
+    data = request.get_json()
+
+    dataset = Dataset.query.get(data['dataset_id'])
+    if dataset is None:
+        abort(404, "Dataset not found")
+
+    user = User.query.filter_by(user_id=get_jwt_identity()).first()
+    if user.company_id != dataset.company_id:
+        abort(401, "No permissions to use dataset")
+
+    grids = {}
+    for key, kind in (('eps', (int, float)), ('k', int), ('m', int)):
+        values = data.get(key)
+        if not isinstance(values, list) or not values or not all(is_number(value, kind) and value > 0 for value in values):
+            abort(400, f"{key} must be a non-empty list of positive numbers")
+        grids[key] = values
+
+    end = data.get("end")
+    if not is_number(end, int) or end <= 0:
+        abort(400, "end must be a positive number")
+    if dataset.frame_count is not None and not (0 < end <= dataset.frame_count):
+        abort(400, f"End frame must be between 1 and {dataset.frame_count}")
+
+    engine = data.get("engine", "dbscan")
+    workers = data.get("workers", 1)
+
+    if engine not in CLUSTERING_ENGINES:
+        abort(400, "Unknown clustering engine")
+
+    if not is_number(workers, int) or workers < 1:
+        abort(400, "Invalid worker count")
+
+    job = sweep_job.delay(filename=dataset.dataset_name, eps_values=grids['eps'], k_values=grids['k'], m_values=grids['m'],
+                          end=end, engine=engine, workers=min(workers, os.cpu_count() or 1))
+
+    jobDb = Job(
+        job_id = job.id,
+        dataset_id = data['dataset_id'],
+        user_id = get_jwt_identity(),
+        company_id = user.company_id,
+        start_time = datetime.datetime.utcnow()
+    )
+    db.session.add(jobDb)
+    db.session.commit()
+
     return jsonify({"job_id": job.id}), 202
 
+@main.route("/job/convoy/cache", methods=["DELETE"])
+@jwt_required()
+def invalidate_convoy_cache():
+    """
+    Drop cached convoy results of a dataset, or of every dataset of the company.
+    ---
+    parameters:
+        - name: dataset_id
+          in: query
+          type: int
+          required: false
+    responses:
+        200:
+            description: Success
+            schema:
+                properties:
+                    removed:
+                        type: int
+                        description: Number of deleted cache entries
+        404:
+            description: Error dataset not found
+        401:
+            description: Error no permissions to dataset
+    """
+    user = User.query.filter_by(user_id=get_jwt_identity()).first()
+
+    dataset_id = request.args.get('dataset_id')
+    if dataset_id is None:
+        datasets = Dataset.query.filter_by(company_id=user.company_id).all()
+    else:
+        dataset = Dataset.query.get(dataset_id)
+        if dataset is None:
+            abort(404, "Dataset not found")
+        if user.company_id != dataset.company_id:
+            abort(401, "No permissions to use dataset")
+        datasets = [dataset]
+
+    # entries are keyed by content, so datasets without a hash have none
+    for dataset in datasets:
+        sync_dataset_stats(dataset)
+    removed = sum(cache_invalidate(dataset.content_hash) for dataset in datasets if dataset.content_hash)
+    return jsonify({"removed": removed}), 200
+
 @main.route('/job/hbd', methods=['POST'])
 @jwt_required()
 def start_hbd():
@@ -274,6 +493,15 @@ def start_hbd():
                     type: int
                     desc: Index of convoy to detect hydrogen bonds
                     required: True
+                distance:
+                    type: float
+                    desc: Maximum N-O distance of a hydrogen bond (default = 3.5)
+                min_angle:
+                    type: float
+                    desc: Minimum H-N...O angle in radians (default = 2.35619)
+                max_angle:
+                    type: float
+                    desc: Maximum H-N...O angle in radians (default = 3.14159)
     responses:
         202:
             description: Success
@@ -285,20 +513,33 @@ def start_hbd():
                         description: ID of the created job
         500:
             description: Error
+        400:
+            description: Error convoy job not finished or convoy index out of range
     """
     data = request.get_json()
 
     user = User.query.filter_by(user_id=get_jwt_identity()).first()
 
     convoy_job = celery.AsyncResult(data['convoy_id'])
+    if convoy_job.status != 'SUCCESS':
+        abort(400, "Convoy job has not finished")
 
+    # reject convoy indexes the convoy job did not find
+    index = data['index']
+    if not is_number(index, int) or not 0 <= index < len(job_convoy_table(convoy_job)):
+        abort(400, "Convoy index out of range")
+
+    # optional hydrogen bond criteria, task defaults otherwise
+    criteria = {key: data[key] for key in ('distance', 'min_angle', 'max_angle') if key in data}
+
+    # the task reads the convoys from the convoy job result file
     job = hb_detection.delay(
         filename = convoy_job.kwargs.get('filename'),
-        convoy = convoy_job.result,
         start_frame=data['start'],
         end_frame=data['end'],
         convoy_index=data['index'],
-        convoy_id=data['convoy_id']
+        convoy_id=data['convoy_id'],
+        **criteria
         )
     
     jobDb = Job(
@@ -319,28 +560,75 @@ def get_all_jobs():
     """
     Get a list of all jobs started by current user.
     ---
+    parameters:
+        - name: offset
+          in: query
+          type: int
+          description: Jobs to skip (default = 0)
+        - name: limit
+          in: query
+          type: int
+          description: Page size, all jobs when missing
+        - name: since
+          in: query
+          type: string
+          description: Only jobs started at or after this ISO date
+        - name: until
+          in: query
+          type: string
+          description: Only jobs started before this ISO date
     responses:
     200:
-        description: Success
+        description: Success, newest jobs first with the total number of matching jobs
+    400:
+        description: Error invalid page or date
     """
     user = User.query.filter_by(user_id=get_jwt_identity()).first()
-    jobs = Job.query.filter_by(company_id=user.company_id).all()
-    job_list = []
+    offset, limit = page_args()
 
-    for job in jobs:
-        jobData = celery.AsyncResult(job.job_id)
+    # one joined query for the job records, one backend query for their states
+    query = (db.session.query(Job, User.full_name, Dataset.dataset_name, Company.company_name)
+             .outerjoin(User, User.user_id == Job.user_id)
+             .outerjoin(Dataset, Dataset.dataset_id == Job.dataset_id)
+             .outerjoin(Company, Company.company_id == Job.company_id)
+             .filter(Job.company_id == user.company_id))
+
+    try:
+        since, until = (datetime.datetime.fromisoformat(request.args[key]) if key in request.args else None for key in ('since', 'until'))
+    except ValueError:
+        abort(400, "Invalid date, expected ISO format")
+    if since is not None:
+        query = query.filter(Job.start_time >= since)
+    if until is not None:
+        query = query.filter(Job.start_time < until)
+
+    total = query.count()
+    query = query.order_by(Job.start_time.desc(), Job.job_id).offset(offset)
+    rows = (query.limit(limit) if limit is not None else query).all()
+    states = job_states([job.job_id for job, *_ in rows])
+
+    job_list = []
+    for job, userName, datasetName, companyName in rows:
         job_list.append({
-            "job_id": jobData.task_id,
-            "job_name": jobData.name,
-            "status": jobData.status,
-            "date_done": jobData.date_done,
-            'user': User.query.filter_by(user_id=job.user_id).first().full_name,
-            'dataset': Dataset.query.filter_by(dataset_id=job.dataset_id).first().dataset_name, 
-            'company': Company.query.filter_by(company_id=job.company_id).first().company_name,
+            "job_id": job.job_id,
+            **states[job.job_id],
+            'user': userName,
+            'dataset': datasetName,
+            'company': companyName,
             'start_time': job.start_time
         })
 
-    return jsonify({'jobs': job_list}), 200
+    return jsonify({'jobs': job_list, 'total': total, 'offset': offset, 'limit': limit}), 200
+
+def page_args():
+    """ offset and limit query arguments of a listing, limit is None when missing """
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = request.args.get('limit')
+        limit = max(0, int(limit)) if limit is not None else None
+    except ValueError:
+        abort(400, "Invalid offset or limit")
+    return offset, limit
 
 @main.route("/job/<jobIn>", methods=["GET"])
 @jwt_required()
@@ -372,7 +660,7 @@ def get_job_status(jobIn):
                     description: Type of job
                 result:
                     type: Unknown
-                    description: Result of the job
+                    description: Result of the job. Convoy jobs give the number of convoys, their largest size and length and convoys_url, the paginated convoy list
     responses:
         200:
             description: Success
@@ -386,11 +674,17 @@ def get_job_status(jobIn):
     #TODO: check if user has permission to check job
     job = celery.AsyncResult(jobIn)
     result = job.result
-    if job.result:
+    if isinstance(result, dict) and result.get('kind') == 'convoys':
+        # the convoys themselves are paged through GET /job/<jobIn>/convoys
+        result = dict(result, convoys_url=f'/job/{jobIn}/convoys')
+    elif isinstance(result, dict) and result.get('kind') == 'hbonds':
+        result = job_hbonds(job)
+    elif job.result:
+        # pickled results of older jobs
         try:
             obj = pickle.loads(job.result)
             if (isinstance(obj, list)) and (isinstance(obj[0], ConvoyCandidate)):
-                result = [convoy.serialize() for convoy in obj]
+                result = dict(convoy_summary(obj), convoys_url=f'/job/{jobIn}/convoys')
             else:
                 result = obj
         except:
@@ -405,6 +699,140 @@ def get_job_status(jobIn):
 
     return jsonify(response), 200
 
+@main.route("/metrics", methods=["GET"])
+def export_metrics():
+    """
+    Task and plot metrics of all web and worker processes in the Prometheus text format.
+    ---
+    responses:
+        200:
+            description: Success
+    """
+    response = make_response(metrics.render())
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+@main.route("/job/<jobIn>/status", methods=["GET"])
+@jwt_required()
+def get_job_state(jobIn):
+    """
+    Poll the status of a job without retrieving its result.
+    ---
+    parameters:
+        - name: job_id
+          in: path
+          type: string
+          required: true
+          description: ID of job
+    responses:
+        200:
+            description: Success, status with the progress of running jobs and the result summary of finished ones
+        401:
+            description: Error Unauthorized
+        404:
+            description: Error job not found
+    """
+    get_company_job(jobIn)
+    job = celery.AsyncResult(jobIn)
+    response = {
+        "job_id": job.task_id,
+        "job_name": job.name,
+        "status": job.status,
+        "date_done": job.date_done,
+        "progress": job.info if job.status == 'PROGRESS' else None,
+        # convoy and hydrogen bond jobs return a small summary, their results are read separately
+        "summary": job.result if isinstance(job.result, dict) else None
+    }
+    return jsonify(response), 200
+
+# Largest page of GET /job/<jobIn>/convoys
+CONVOY_PAGE_LIMIT = 1000
+
+@main.route("/job/<jobIn>/convoys", methods=["GET"])
+@jwt_required()
+def list_job_convoys(jobIn):
+    """
+    Page through the convoys of a finished convoy job.
+    ---
+    parameters:
+        - name: job_id
+          in: path
+          type: string
+          required: true
+          description: ID of convoy job
+        - name: offset
+          in: query
+          type: int
+          description: Convoys to skip (default = 0)
+        - name: limit
+          in: query
+          type: int
+          description: Page size (default = 100, at most 1000)
+        - name: sort
+          in: query
+          type: string
+          description: size, length, start or end, emission order when missing
+        - name: order
+          in: query
+          type: string
+          description: asc (default) or desc
+        - name: min_size
+          in: query
+          type: int
+          description: Also max_size, min_length, max_length, min_start, max_start, min_end and max_end
+        - name: members
+          in: query
+          type: boolean
+          description: Include the member indices of every convoy on the page
+    responses:
+        200:
+            description: Success, total number of matching convoys and the requested page, every convoy with its index in the job result
+        400:
+            description: Error invalid query or job not finished
+        401:
+            description: Error Unauthorized
+        404:
+            description: Error job not found
+    """
+    get_company_job(jobIn)
+    job = celery.AsyncResult(jobIn)
+    if job.status != 'SUCCESS':
+        abort(400, f"Job is {job.status}")
+
+    args = request.args
+    try:
+        offset = max(0, int(args.get('offset', 0)))
+        limit = min(max(0, int(args.get('limit', 100))), CONVOY_PAGE_LIMIT)
+        filters = {name: (args.get(f'min_{name}', type=int), args.get(f'max_{name}', type=int)) for name in ConvoyTable.COLUMNS}
+    except ValueError:
+        abort(400, "Invalid offset or limit")
+
+    sort = args.get('sort')
+    if sort is not None and sort not in ConvoyTable.COLUMNS:
+        abort(400, f"sort must be one of {', '.join(ConvoyTable.COLUMNS)}")
+
+    table = job_convoy_table(job)
+    selected = table.query(filters, sort, descending=args.get('order') == 'desc')
+    response = {
+        "job_id": jobIn,
+        "total": len(selected),
+        "offset": offset,
+        "limit": limit,
+        "convoys": table.serialize(selected[offset:offset + limit], members=args.get('members') == 'true')
+    }
+    return jsonify(response), 200
+
+def get_company_job(job_id):
+    """ Job record of job_id, aborting unless it belongs to the company of the current user """
+    jobDb = Job.query.filter_by(job_id=job_id).first()
+    if jobDb is None:
+        abort(404, "Job not found")
+    user = User.query.filter_by(user_id=get_jwt_identity()).first()
+    if user.company_id != jobDb.company_id:
+        abort(401, "No permissions to access job")
+    return jobDb
+
 @main.route("/dataset", methods=["POST"])
 @jwt_required()
 def upload_dataset():
@@ -417,9 +845,9 @@ def upload_dataset():
           required: true
     responses:
         201:
-            description: Success dataset uploaded
+            description: Success dataset uploaded, statistics follow once profiled
         400:
-            description: Error
+            description: Error duplicate or invalid dataset
     """
 
     uploaded_file = request.files['file']
@@ -432,12 +860,43 @@ def upload_dataset():
     # retrieve user information first
     user = User.query.filter_by(user_id=get_jwt_identity()).first()
 
-    if not os.path.exists('/usr/src/app/data/'):
-        os.makedirs('/usr/src/app/data/', mode=0o777)
+    if not os.path.exists(DATA_DIR):
+        os.makedirs(DATA_DIR, mode=0o777)
+
+    reject_duplicate_dataset(sec_filename)
+
+    # save file
+    uploaded_file.save(dataset_path(sec_filename))
+
+    # only the header is read here, rejecting unreadable files, the full pass runs in the background
+    try:
+        stats = describe_dataset(sec_filename)
+    except ValueError as e:
+        remove_dataset_files(sec_filename)
+        abort(400, f"Invalid dataset: {e}")
+
+    # initialize dataset object
+    dataset_metadata = Dataset(
+        dataset_name=sec_filename,
+        user_id=user.user_id,
+        company_id=user.company_id,
+        **stats
+    )
+
+    # add to database and commit change if successful
+    db.session.add(dataset_metadata)
+    db.session.commit()
+
+    # profile, then convert into the chunked layout
+    (profile_dataset_job.si(filename=sec_filename) | convert_dataset_job.si(filename=sec_filename)).delay()
+
+    return jsonify({'message': "Upload successful", 'dataset_id': dataset_metadata.dataset_id}), 201
 
+def reject_duplicate_dataset(sec_filename):
+    """Abort when a dataset of this name exists, cleaning up a record or file left without the other"""
     # check for duplicate filenames in database
     dup_dataset = Dataset.query.filter_by(dataset_name=sec_filename).first()
-    if (dup_dataset is not None) and (os.path.exists(f'/usr/src/app/data/{sec_filename}')):
+    if (dup_dataset is not None) and (os.path.exists(dataset_path(sec_filename))):
         # no mismatch, true diplicate
         abort(400, "Duplicate filename")
 
@@ -447,26 +906,246 @@ def upload_dataset():
         db.session.commit()
         abort(400, "Duplicate filename only in database, deleting record.")
 
-    if os.path.exists(f'/usr/src/app/data/{sec_filename}'):
+    if os.path.exists(dataset_path(sec_filename)):
         # mismatch (file exists only in filesystem)
-        os.remove(f'/usr/src/app/data/{sec_filename}')
+        remove_dataset_files(sec_filename)
         abort(400, "Duplicate filename only in filesystem, deleting file")
 
-    # initialize dataset object
+@main.route("/dataset/upload", methods=["POST"])
+@jwt_required()
+def start_upload():
+    """
+    Start a chunked upload of a large dataset
+    ---
+    parameters:
+        - name: filename
+          in: body
+          type: string
+          required: true
+        - name: size
+          in: body
+          type: int
+          required: true
+          description: Byte size of the file
+        - name: chunk_size
+          in: body
+          type: int
+          required: false
+          description: Byte size of every chunk but the last (default = 64 MiB)
+    responses:
+        201:
+            description: Success, send the chunks with PUT /dataset/upload/<upload_id>
+            schema:
+                properties:
+                    upload_id:
+                        type: string
+                    chunk_size:
+                        type: int
+                    chunks:
+                        type: int
+        400:
+            description: Error duplicate or invalid dataset
+        507:
+            description: Error not enough disk space
+    """
+    data = request.get_json()
+    sec_filename = secure_filename(data.get('filename', ''))
+    if sec_filename == '':
+        # no null filenames
+        abort(400, "Null filename")
+
+    user = User.query.filter_by(user_id=get_jwt_identity()).first()
+    reject_duplicate_dataset(sec_filename)
+
+    try:
+        session = create_upload(sec_filename, int(data['size']), int(data.get('chunk_size', UPLOAD_CHUNK_SIZE)),
+                                user_id=user.user_id, company_id=user.company_id)
+    except (KeyError, TypeError, ValueError) as e:
+        abort(400, f"Invalid upload: {e}")
+    except OSError:
+        abort(507, "Not enough disk space for the dataset")
+
+    return jsonify({'upload_id': session['upload_id'], 'chunk_size': session['chunk_size'], 'chunks': chunk_count(session)}), 201
+
+def get_user_upload(upload_id):
+    """Upload session of the requesting user, aborts when there is none"""
+    session = read_upload(upload_id)
+    if session is None:
+        abort(404, "Upload not found")
+    if session['user_id'] != User.query.filter_by(user_id=get_jwt_identity()).first().user_id:
+        abort(401, "No permissions to access upload")
+    return session
+
+@main.route("/dataset/upload/<upload_id>", methods=["GET"])
+@jwt_required()
+def get_upload_status(upload_id):
+    """
+    Progress of a chunked upload, to resume it after an interruption
+    ---
+    parameters:
+        - name: upload_id
+          in: path
+          type: string
+          required: true
+    responses:
+        200:
+            description: Success, missing lists the chunks still to send
+        404:
+            description: Error upload not found
+        401:
+            description: Error no permissions to upload
+    """
+    session = get_user_upload(upload_id)
+    missing = missing_chunks(session)
+    return jsonify({
+        'upload_id': session['upload_id'],
+        'filename': session['filename'],
+        'size': session['size'],
+        'chunk_size': session['chunk_size'],
+        'chunks': chunk_count(session),
+        'missing': missing
+    }), 200
+
+@main.route("/dataset/upload/<upload_id>", methods=["PUT"])
+@jwt_required()
+def upload_chunk(upload_id):
+    """
+    Send one chunk of a chunked upload as the raw request body
+
+    Chunks may be sent in any order and several at once, a chunk sent again
+    replaces the earlier one.
+    ---
+    parameters:
+        - name: upload_id
+          in: path
+          type: string
+          required: true
+        - name: Content-Range
+          in: header
+          type: string
+          required: true
+          description: bytes <first>-<last>/<size> of exactly one chunk
+        - name: X-Chunk-SHA256
+          in: header
+          type: string
+          required: false
+          description: Hex SHA-256 of the chunk, checked before it counts as received
+    responses:
+        200:
+            description: Success chunk stored
+        400:
+            description: Error range is not a chunk, body too short or checksum mismatch
+        404:
+            description: Error upload not found
+        401:
+            description: Error no permissions to upload
+    """
+    session = get_user_upload(upload_id)
+    contentRange = parse_content_range_header(request.headers.get('Content-Range'))
+    if contentRange is None or contentRange.units != 'bytes' or contentRange.length != session['size']:
+        abort(400, "Missing or invalid Content-Range")
+
+    try:
+        index, sha256 = write_chunk(session, contentRange.start, contentRange.stop, request.stream,
+                                    request.headers.get('X-Chunk-SHA256'))
+    except UploadError as e:
+        abort(400, str(e))
+    return jsonify({'chunk': index, 'sha256': sha256}), 200
+
+@main.route("/dataset/upload/<upload_id>/complete", methods=["POST"])
+@jwt_required()
+def complete_upload(upload_id):
+    """
+    Finish a chunked upload, create the dataset and start its post-processing
+    ---
+    parameters:
+        - name: upload_id
+          in: path
+          type: string
+          required: true
+        - name: sha256
+          in: body
+          type: string
+          required: true
+          description: Hex SHA-256 of the concatenated binary SHA-256 digests of all chunks, in chunk order
+    responses:
+        201:
+            description: Success dataset uploaded, statistics follow once profiled
+        400:
+            description: Error checksum mismatch, duplicate or invalid dataset
+        404:
+            description: Error upload not found
+        401:
+            description: Error no permissions to upload
+        409:
+            description: Error chunks missing, listed in missing, or the upload is being completed by another request
+    """
+    session = get_user_upload(upload_id)
+    try:
+        with lock_upload(session['upload_id']):
+            # another request may have finished it before the lock was taken
+            if read_upload(session['upload_id']) is None:
+                abort(404, "Upload not found")
+            missing = missing_chunks(session)
+            if missing:
+                return jsonify({'message': "Upload incomplete", 'missing': missing}), 409
+
+            checksum = (request.get_json() or {}).get('sha256')
+            if not isinstance(checksum, str) or checksum.lower() != upload_checksum(session):
+                abort(400, "Checksum mismatch")
+
+            sec_filename = session['filename']
+            reject_duplicate_dataset(sec_filename)
+            finish_upload(session)
+    except UploadLocked:
+        abort(409, "Upload is being completed")
+    except FileNotFoundError:
+        # the session files went away under us, e.g. expired or cancelled
+        abort(404, "Upload not found")
+
+    # only the header is read here, the full pass runs in the background
+    try:
+        stats = describe_dataset(sec_filename)
+    except ValueError as e:
+        remove_dataset_files(sec_filename)
+        abort(400, f"Invalid dataset: {e}")
+
     dataset_metadata = Dataset(
         dataset_name=sec_filename,
-        user_id=user.user_id,
-        company_id=user.company_id
+        user_id=session['user_id'],
+        company_id=session['company_id'],
+        **stats
     )
-
-    # save file
-    uploaded_file.save(f'/usr/src/app/data/{sec_filename}')
-
-    # add to database and commit change if successful
     db.session.add(dataset_metadata)
     db.session.commit()
 
-    return jsonify({'message': "Upload successful"}), 201
+    # profile, then convert into the chunked layout
+    (profile_dataset_job.si(filename=sec_filename) | convert_dataset_job.si(filename=sec_filename)).delay()
+
+    return jsonify({'message': "Upload successful", 'dataset_id': dataset_metadata.dataset_id}), 201
+
+@main.route("/dataset/upload/<upload_id>", methods=["DELETE"])
+@jwt_required()
+def abort_upload(upload_id):
+    """
+    Cancel a chunked upload and delete its data
+    ---
+    parameters:
+        - name: upload_id
+          in: path
+          type: string
+          required: true
+    responses:
+        200:
+            description: Success upload deleted
+        404:
+            description: Error upload not found
+        401:
+            description: Error no permissions to upload
+    """
+    session = get_user_upload(upload_id)
+    remove_upload(session['upload_id'])
+    return jsonify({'message': "Upload deleted"}), 200
 
 @main.route('/dataset', methods=['GET'])
 @jwt_required()
@@ -474,18 +1153,69 @@ def list_company_datasets():
     """
     List all available datasets under company.
     ---
+    parameters:
+        - name: offset
+          in: query
+          type: int
+          description: Datasets to skip (default = 0)
+        - name: limit
+          in: query
+          type: int
+          description: Page size, all datasets when missing
     responses:
         200:
-            description: List of all datasets under companies
+            description: List of all datasets under companies, with the total number of datasets
+        400:
+            description: Error invalid page
     """
     user = User.query.filter_by(user_id=get_jwt_identity()).first()
     cid = user.company_id
+    offset, limit = page_args()
     companyName = Company.query.filter_by(company_id=cid).first().company_name
-    datasets = Dataset.query.filter_by(company_id=cid).all()
+
+    query = (db.session.query(Dataset, User.full_name)
+             .outerjoin(User, User.user_id == Dataset.user_id)
+             .filter(Dataset.company_id == cid))
+    total = query.count()
+    query = query.order_by(Dataset.dataset_id).offset(offset)
+    rows = (query.limit(limit) if limit is not None else query).all()
+
+    for dataset, _ in rows:
+        sync_dataset_stats(dataset)
 
     dataset_list = [{'dataset_id': dataset.dataset_id, 'dataset_name': dataset.dataset_name, 
-                     'company_name': companyName, 'user': User.query.filter_by(user_id=dataset.user_id).first().full_name} for dataset in datasets]
-    return jsonify({'datasets': dataset_list}), 200
+                     'company_name': companyName, 'user': userName,
+                     **serialize_dataset_stats(dataset)} for dataset, userName in rows]
+    return jsonify({'datasets': dataset_list, 'total': total, 'offset': offset, 'limit': limit}), 200
+
+# Dataset columns filled from the profile of the dataset
+DATASET_STATS = ('frame_count', 'atom_count', 'dtype', 'min_x', 'min_y', 'min_z', 'max_x', 'max_y', 'max_z', 'content_hash')
+
+def sync_dataset_stats(dataset):
+    """Copy the statistics of a dataset profiled in the background from its sidecar into its row"""
+    if dataset.content_hash is not None:
+        return
+    meta = read_metadata(dataset.dataset_name)
+    if 'content_hash' not in meta:
+        return
+    for column in DATASET_STATS:
+        setattr(dataset, column, meta.get(column))
+    dataset.atom_types = json.dumps(meta.get('atom_types', {}))
+    db.session.commit()
+
+def serialize_dataset_stats(dataset):
+    """Upload-time statistics of a dataset, None for datasets not profiled yet"""
+    return {
+        'frame_count': dataset.frame_count,
+        'atom_count': dataset.atom_count,
+        'dtype': dataset.dtype,
+        'bounds': {
+            'min': [dataset.min_x, dataset.min_y, dataset.min_z],
+            'max': [dataset.max_x, dataset.max_y, dataset.max_z]
+        },
+        'content_hash': dataset.content_hash,
+        'atom_types': json.loads(dataset.atom_types) if dataset.atom_types else None
+    }
 
 @main.route('/companies', methods=['GET'])
 def list_companies():
@@ -540,7 +1270,49 @@ def get_company_info(id):
     }
     return jsonify(response), 200
 
-@main.route('/visualize/hb', methods=["POST"])
+# Figures of finished jobs never change, so they are built once and served from here
+figure_cache = FigureCache()
+
+def figure_response(key, build, *jobs):
+    """
+    Serve a figure through figure_cache
+
+    The key doubles as ETag, a matching If-None-Match is answered with 304
+    without loading the figure. Figures of unfinished jobs are refused.
+    """
+    for job in jobs:
+        if job.status != 'SUCCESS':
+            abort(400, f"Job {job.id} is {job.status}")
+
+    if request.if_none_match.contains(key):
+        response = make_response('', 304)
+    else:
+        response = make_response(figure_cache.get(key, build))
+        response.mimetype = 'application/json'
+    response.set_etag(key)
+    # clients keep the figure but revalidate it on every use
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def visualize_args():
+    """ Body of POST requests, query arguments of GET requests """
+    return request.get_json(silent=True) or request.args.to_dict()
+
+def level_of_detail(data):
+    """ max_points, stride and encoding of a visualize request, part of the figure key """
+    try:
+        lod = {key: int(data[key]) if data.get(key) is not None else None for key in ('max_points', 'stride')}
+    except (TypeError, ValueError):
+        abort(400, "max_points and stride must be integers")
+    if any(value is not None and value < 1 for value in lod.values()):
+        abort(400, "max_points and stride must be positive")
+    lod['encoding'] = data.get('encoding', 'base64')
+    if lod['encoding'] not in FIGURE_ENCODINGS:
+        abort(400, f"encoding must be one of {', '.join(FIGURE_ENCODINGS)}")
+    return lod
+
+@main.route('/visualize/hb', methods=["GET", "POST"])
 def visualize_hb():
     """
     Generate the visualization of the Hydrogen Bonds in a Convoy
@@ -561,21 +1333,43 @@ def visualize_hb():
           type: int
           required: true
           description: Index of the convoy to visualize
+        - name: max_points
+          in: body
+          type: int
+          required: false
+          description: Most atoms plotted per frame, a spatially stratified subsample (default = all)
+        - name: stride
+          in: body
+          type: int
+          required: false
+          description: Plot every stride-th frame
+        - name: encoding
+          in: body
+          type: string
+          required: false
+          description: base64 (default) for binary typed arrays, json for decimal numbers
     responses:
         200:
-            description: Success
+            description: Success, the figure JSON with an ETag
+        304:
+            description: The figure of the If-None-Match ETag is unchanged
+        400:
+            description: Error job not finished or invalid level of detail
         500:
             desciption: Error
         401:
             description: Error Unauthorized
     """
     #TODO: add user verification
-    data = request.get_json()
+    data = visualize_args()
+    lod = level_of_detail(data)
     hb = celery.AsyncResult(data['hbd_id'])
     convoy = celery.AsyncResult(hb.kwargs.get('convoy_id'))
-    return generate_hb_plot(convoy.result, hb.result, convoy.kwargs.get('filename'), convoy.kwargs.get('end'), convoy_index=hb.kwargs.get('convoy_index'))
+    convoy_index = hb.kwargs.get('convoy_index')
+    build = lambda: generate_hb_plot(job_convoys(convoy), job_hbonds(hb), convoy.kwargs.get('filename'), convoy.kwargs.get('end'), convoy_index=convoy_index, **lod)
+    return figure_response(figure_key(hb.id, 'hb', convoy_index, **lod), build, convoy, hb)
 
-@main.route('/visualize/convoy', methods=["POST"])
+@main.route('/visualize/convoy', methods=["GET", "POST"])
 def visualize_convoy():
     """
     Generate the visualization of the Convoy
@@ -591,20 +1385,42 @@ def visualize_convoy():
           type: int
           required: true
           description: Index of the convoy to visualize
+        - name: max_points
+          in: body
+          type: int
+          required: false
+          description: Most atoms plotted per frame, a spatially stratified subsample (default = all)
+        - name: stride
+          in: body
+          type: int
+          required: false
+          description: Plot every stride-th frame
+        - name: encoding
+          in: body
+          type: string
+          required: false
+          description: base64 (default) for binary typed arrays, json for decimal numbers
     responses:
         200:
-            description: Success
+            description: Success, the figure JSON with an ETag
+        304:
+            description: The figure of the If-None-Match ETag is unchanged
+        400:
+            description: Error job not finished or invalid level of detail
         500:
             desciption: Error
         401:
             description: Error Unauthorized
     """
     #TODO: add user verification
-    data = request.get_json()
+    data = visualize_args()
+    lod = level_of_detail(data)
     convoy = celery.AsyncResult(data['convoy_id'])
-    return generate_convoy_plot(convoy.result, convoy.kwargs.get('filename'), convoy.kwargs.get('end'), convoy_index=data['index'])
+    convoy_index = int(data['index'])
+    build = lambda: generate_convoy_plot(job_convoys(convoy), convoy.kwargs.get('filename'), convoy.kwargs.get('end'), convoy_index=convoy_index, **lod)
+    return figure_response(figure_key(convoy.id, 'convoy', convoy_index, **lod), build, convoy)
 
-@main.route('/visualize/context', methods=["POST"])
+@main.route('/visualize/context', methods=["GET", "POST"])
 def visualize_context():
     """
     Generate the visualization of the Convoy Context
@@ -615,18 +1431,39 @@ def visualize_context():
           type: string
           required: true
           description: ID of convoy job for visualization
+        - name: max_points
+          in: body
+          type: int
+          required: false
+          description: Most atoms plotted per frame, a spatially stratified subsample (default = all)
+        - name: stride
+          in: body
+          type: int
+          required: false
+          description: Plot every stride-th frame
+        - name: encoding
+          in: body
+          type: string
+          required: false
+          description: base64 (default) for binary typed arrays, json for decimal numbers
     responses:
         200:
-            description: Success
+            description: Success, the figure JSON with an ETag
+        304:
+            description: The figure of the If-None-Match ETag is unchanged
+        400:
+            description: Error job not finished or invalid level of detail
         500:
             desciption: Error
         401:
             description: Error Unauthorized
     """
     #TODO: add user verification
-    data = request.get_json()
+    data = visualize_args()
+    lod = level_of_detail(data)
     convoy = celery.AsyncResult(data['convoy_id'])
-    return generate_context_plot(convoy.result, convoy.kwargs.get('filename'), convoy.kwargs.get('end'))
+    build = lambda: generate_context_plot(job_convoys(convoy), convoy.kwargs.get('filename'), convoy.kwargs.get('end'), **lod)
+    return figure_response(figure_key(convoy.id, 'context', **lod), build, convoy)
 
 @main.route('/companies/add', methods=['POST'])
 def register_company():
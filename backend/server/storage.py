@@ -0,0 +1,224 @@
+import os, json, hashlib
+import numpy as np
+
+from .algorithms import BOX_SIZE, PERIODIC_AXES, getAtomTypeIndex
+
+DATA_DIR = '/usr/src/app/data'
+
+def dataset_path(filename):
+    return f'{DATA_DIR}/{filename}'
+
+# Default tile size of the chunked layout
+CHUNK_FRAMES = 32
+BLOCK_ATOMS = 256
+
+def metadata_path(filename):
+    return f'{dataset_path(filename)}.json'
+
+def atom_major_path(filename):
+    return f'{dataset_path(filename)}.atoms.npy'
+
+def read_metadata(filename):
+    """The `<filename>.json` sidecar of a dataset, empty when there is none"""
+    metaPath = metadata_path(filename)
+    if not os.path.exists(metaPath):
+        return {}
+    with open(metaPath) as file:
+        return json.load(file)
+
+def write_metadata(filename, meta):
+    """Replace the sidecar of a dataset atomically"""
+    tmpPath = metadata_path(filename) + '.tmp'
+    with open(tmpPath, 'w') as file:
+        json.dump(meta, file)
+    os.replace(tmpPath, metadata_path(filename))
+
+def remove_dataset_files(filename):
+    """Delete a dataset together with its sidecar and converted layout"""
+    for path in (dataset_path(filename), metadata_path(filename), atom_major_path(filename)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def get_box(filename):
+    """Box dimensions and periodicity of a dataset, from its optional `<filename>.json` metadata"""
+    meta = read_metadata(filename)
+    return meta.get('box', BOX_SIZE), meta.get('periodic', PERIODIC_AXES)
+
+def open_dataset(filename):
+    """
+    Read-only memmap of a (frames, atoms, 3) dataset
+
+    Nothing is read until the returned array is indexed, so callers only page
+    in the frames and atoms they touch.
+    """
+    return np.load(dataset_path(filename), mmap_mode='r')
+
+def load_frames(filename, end=None, start=0):
+    """Frames first (frames, atoms, 3) memmap view of the frame range [start, end)"""
+    return open_dataset(filename)[start:end]
+
+def load_frame_selection(filename, frames):
+    """(frames, atoms, 3) array of the selected frames only"""
+    return np.asarray(open_dataset(filename)[np.asarray(frames, dtype=np.int64)])
+
+def convert_dataset(filename, chunk_frames=CHUNK_FRAMES, block_atoms=BLOCK_ATOMS):
+    """
+    Convert an uploaded dataset into the chunked on-disk layout
+
+    The uploaded (frames, atoms, 3) .npy is kept as the frame-major path: one
+    frame is one contiguous slice. The atom-major path is `<filename>.atoms.npy`
+    of shape (atom blocks, frame chunks, chunk_frames, block_atoms, 3), where the
+    time series of an atom block is one contiguous region. Edge tiles are zero
+    padded. The sidecar records shape, dtype, box, tile size and the coordinate
+    bounds of every frame chunk.
+
+    The dataset is read one frame chunk at a time.
+
+    Returns
+    -------
+    the new sidecar metadata
+    """
+    data = open_dataset(filename)
+    frames, atoms = data.shape[:2]
+    frameChunks = -(-frames // chunk_frames)
+    atomBlocks = max(1, -(-atoms // block_atoms))
+
+    tmpPath = atom_major_path(filename) + '.tmp.npy'
+    tiles = np.lib.format.open_memmap(tmpPath, mode='w+', dtype=data.dtype,
+                                      shape=(atomBlocks, frameChunks, chunk_frames, block_atoms, 3))
+    chunks = []
+    for chunk in range(frameChunks):
+        start, end = chunk * chunk_frames, min((chunk + 1) * chunk_frames, frames)
+        block = np.zeros((chunk_frames, atomBlocks * block_atoms, 3), dtype=data.dtype)
+        block[:end - start, :atoms] = data[start:end]
+        tiles[:, chunk] = block.reshape(chunk_frames, atomBlocks, block_atoms, 3).transpose(1, 0, 2, 3)
+
+        coords = block[:end - start, :atoms].reshape(-1, 3)
+        chunks.append({
+            'start': start,
+            'end': end,
+            'min': coords.min(axis=0).tolist() if len(coords) else None,
+            'max': coords.max(axis=0).tolist() if len(coords) else None
+        })
+    tiles.flush()
+    del tiles
+    os.replace(tmpPath, atom_major_path(filename))
+
+    meta = read_metadata(filename)
+    box, periodic = get_box(filename)
+    meta.update({
+        'shape': list(data.shape),
+        'dtype': data.dtype.str,
+        'box': list(box),
+        'periodic': list(periodic),
+        'chunk_frames': chunk_frames,
+        'block_atoms': block_atoms,
+        'chunks': chunks
+    })
+    write_metadata(filename, meta)
+    return meta
+
+def open_atom_major(filename, meta=None):
+    """Read-only memmap of the atom-major tiles, None if the dataset was not converted"""
+    meta = read_metadata(filename) if meta is None else meta
+    if 'block_atoms' not in meta or not os.path.exists(atom_major_path(filename)):
+        return None
+    return np.load(atom_major_path(filename), mmap_mode='r')
+
+def describe_dataset(filename):
+    """
+    Shape and dtype of a dataset from its .npy header, without reading the data
+
+    Returns
+    -------
+    dict with frame_count, atom_count and dtype, raises ValueError for files
+    that are not a (frames, atoms, 3) array
+    """
+    data = open_dataset(filename)
+    if data.ndim != 3 or data.shape[2] != 3:
+        raise ValueError(f'Expected a (frames, atoms, 3) array, got shape {data.shape}')
+    return {'frame_count': data.shape[0], 'atom_count': data.shape[1], 'dtype': data.dtype.str}
+
+def profile_dataset(filename, chunk_frames=CHUNK_FRAMES):
+    """
+    Dataset statistics from a single chunked pass over the file
+
+    Returns
+    -------
+    dict with frame_count, atom_count, dtype, the coordinate bounds min_x .. max_z,
+    content_hash (sha256 of dtype, shape and array bytes) and atom_types, the
+    number of dataset atoms of every type in atomType.pkl
+
+    """
+    describe_dataset(filename)
+    data = open_dataset(filename)
+    frames, atoms = data.shape[:2]
+
+    digest = hashlib.sha256(f'{data.dtype.str}{data.shape}'.encode())
+    low = np.full(3, np.inf)
+    high = np.full(3, -np.inf)
+    for start in range(0, frames, chunk_frames):
+        chunk = np.ascontiguousarray(data[start:start + chunk_frames])
+        digest.update(chunk.data)
+        if chunk.size:
+            low = np.minimum(low, chunk.min(axis=(0, 1)))
+            high = np.maximum(high, chunk.max(axis=(0, 1)))
+
+    atomTypes = {}
+    atomTypePath = f'{DATA_DIR}/atomType.pkl'
+    if os.path.exists(atomTypePath):
+        index = getAtomTypeIndex(atomTypePath)
+        codes = index.type_of(np.arange(atoms))
+        atomTypes = {name: int(np.count_nonzero(codes == code)) for code, name in enumerate(index.names)}
+
+    bounds = np.stack((low, high)) if frames and atoms else np.full((2, 3), np.nan)
+    stats = {
+        'frame_count': frames,
+        'atom_count': atoms,
+        'dtype': data.dtype.str,
+        'content_hash': digest.hexdigest(),
+        'atom_types': atomTypes
+    }
+    for row, bound in enumerate(('min', 'max')):
+        for axis, name in enumerate('xyz'):
+            value = float(bounds[row, axis])
+            stats[f'{bound}_{name}'] = None if np.isnan(value) else value
+    return stats
+
+def load_atoms(filename, atoms, start=0, end=None):
+    """
+    Coordinates of an atom subset over the frame range [start, end)
+
+    Parameters
+    ----------
+    filename : dataset name
+    atoms : sequence of atom indices
+    start, end : frame range
+
+    Returns
+    -------
+    Numpy array of shape (frames, len(atoms), 3)
+
+    Converted datasets are read from the atom-major tiles, one contiguous
+    region per atom block and frame chunk.
+    """
+    atoms = np.asarray(atoms, dtype=np.int64)
+    meta = read_metadata(filename)
+    tiles = open_atom_major(filename, meta)
+    if tiles is None:
+        return np.asarray(open_dataset(filename)[start:end, atoms])
+
+    start, end, _ = slice(start, end).indices(meta['shape'][0])
+    chunk_frames, block_atoms = meta['chunk_frames'], meta['block_atoms']
+    series = np.empty((max(end - start, 0), len(atoms), 3), dtype=tiles.dtype)
+    if len(series) == 0 or len(atoms) == 0:
+        return series
+
+    first, last = start // chunk_frames, (end - 1) // chunk_frames + 1
+    offset = first * chunk_frames
+    blocks = atoms // block_atoms
+    for block in np.unique(blocks):
+        select = np.flatnonzero(blocks == block)
+        blockSeries = np.asarray(tiles[block, first:last]).reshape(-1, block_atoms, 3)
+        series[:, select] = blockSeries[start - offset:end - offset, atoms[select] - block * block_atoms]
+    return series
@@ -0,0 +1,273 @@
+import json, pickle
+import numpy as np
+
+from .algorithms import PERIODIC_AXES, ConvoyCandidate
+
+# Atoms per cubic Angstrom of the default box, sparse enough that the
+# transient background groups rarely touch each other
+SYNTHETIC_DENSITY = 1 / 1500
+
+# Geometry of a planted hydrogen bond site, in Angstrom: the N-H bond, the
+# N-O distance of a bonded and a broken site and the filler ring radius
+NH_LENGTH = 1.0
+NO_BONDED = 2.9
+NO_BROKEN = 4.2
+FILLER_RADIUS = 1.0
+FILLER_ATOMS = 3
+HB_SITE_ATOMS = 3 + FILLER_ATOMS
+
+class SyntheticTrajectory(object):
+    """Deterministic synthetic trajectory with its planted ground truth
+
+    Attributes:
+        positions (ndarray): The (frames, atoms, 3) float32 coordinates
+        box (tuple): The box dimensions
+        periodic (tuple): The axis periodicity
+        convoys (list): The planted convoys as ConvoyCandidate, sorted member indices, first and last frame
+        hbonds (list): The planted [hn, n, o] bonds of every frame
+        atom_types (dict): "n", "hn" and "o" to atom index lists, the atomType.pkl layout
+    """
+    def __init__(self, positions, box, periodic, convoys, hbonds, atom_types):
+        self.positions = positions
+        self.box = box
+        self.periodic = periodic
+        self.convoys = convoys
+        self.hbonds = hbonds
+        self.atom_types = atom_types
+
+    def __repr__(self):
+        return '<%r shape=%r, convoys=%r, hbond_sites=%r>' % (self.__class__.__name__, self.positions.shape, len(self.convoys), len(self.atom_types['n']))
+
+    def hb_atoms(self):
+        """ The hydrogen bond atoms grouped like AtomTypeIndex.group, for getHB """
+        return {name: np.asarray(indices, dtype=np.int64) for name, indices in self.atom_types.items()}
+
+    def save(self, path, atom_types_path=None):
+        """
+        Write the trajectory as a dataset: the .npy at path, its box in the
+        `<path>.json` sidecar and optionally the atom types pickle
+        """
+        np.save(path, self.positions)
+        with open(f'{path}.json', 'w') as file:
+            json.dump({'box': list(self.box), 'periodic': list(self.periodic)}, file)
+        if atom_types_path is not None:
+            with open(atom_types_path, 'wb') as file:
+                pickle.dump(self.atom_types, file)
+
+def size_range(value):
+    """ (low, high) of an int or an inclusive range """
+    return (value, value) if np.isscalar(value) else tuple(value)
+
+def ball_offsets(rng, count, radius):
+    """ count points uniformly distributed in a ball of the given radius """
+    direction = rng.normal(size=(count, 3))
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True).clip(min=1e-12)
+    return direction * (radius * rng.random((count, 1)) ** (1 / 3))
+
+def group_sizes(rng, count, low, high):
+    """ Random sizes in [low, high] summing to count, the last one may be smaller than low """
+    sizes = []
+    while count > high:
+        size = int(rng.integers(low, high + 1))
+        if count - size < low and count - low >= low:
+            size = count - low
+        sizes.append(size)
+        count -= size
+    if count:
+        sizes.append(count)
+    return sizes
+
+def hb_site_offsets(rng):
+    """
+    (bonded, broken) offsets of the N, H, O and filler atoms of one site
+
+    H sits slightly off the N-O axis, the H-N...O angle stays well inside the
+    bond criteria. The filler atoms keep the site one cluster of DBSCAN cores
+    in both states, so it is never clustering noise.
+    """
+    axis = rng.normal(size=3)
+    axis /= np.linalg.norm(axis)
+    side = np.cross(axis, np.eye(3)[np.argmin(np.abs(axis))])
+    side /= np.linalg.norm(side)
+    up = np.cross(axis, side)
+
+    n = -NO_BONDED / 2 * axis
+    h = n + NH_LENGTH * (np.cos(0.15) * axis + np.sin(0.15) * side)
+    angles = 2 * np.pi * np.arange(FILLER_ATOMS) / FILLER_ATOMS
+    fillers = FILLER_RADIUS * (np.cos(angles)[:, None] * side + np.sin(angles)[:, None] * up)
+    bonded = np.vstack((n, h, n + NO_BONDED * axis, fillers))
+    broken = np.vstack((n, h, n + NO_BROKEN * axis, fillers))
+    return bonded, broken
+
+def generate_trajectory(frames=100, atoms=2000, convoys=4, convoy_size=(8, 16), lifetime=(10, 40),
+                        hbond_sites=8, bond_fraction=0.5, noise_group=(5, 7), box=None, periodic=PERIODIC_AXES,
+                        density=SYNTHETIC_DENSITY, radius=1.5, noise_radius=1.2, jitter=0.05, drift=2.0,
+                        drift_period=50, separation=4.0, seed=0):
+    """
+    Synthetic trajectory with planted convoys, hydrogen bonds and background noise
+
+    Convoys and hydrogen bond sites sit on distinct cells of a regular lattice
+    and drift together, so sites never meet. A convoy keeps its members within
+    radius of its center during its lifetime. Outside of it they are
+    background atoms. Every frame the background atoms are regrouped at random
+    into transient groups of noise_group atoms at random places, or scattered
+    uniformly when noise_group is None. CMC clusters the noise label of the
+    DBSCAN engines like any other, so scattered noise only suits the periodic
+    engine. A hydrogen bond site is N, H, O and filler atoms, bonded on a
+    bond_fraction of the frames and broken on the others. Every atom moves by
+    up to jitter per coordinate every frame. Nothing leaves the box, also
+    along periodic axes.
+
+    Parameters
+    ----------
+    frames, atoms : trajectory shape, atoms includes convoy and site atoms
+    convoys : number of planted convoys
+    convoy_size, lifetime : int or inclusive (low, high) range of the
+        members and frames of every convoy
+    hbond_sites : number of planted hydrogen bond sites
+    bond_fraction : probability of a site being bonded at a frame
+    noise_group : (low, high) size of the transient background groups, CMC
+        with m > high ignores them, or None
+    box : box dimensions, by default a cube holding atoms at density
+    periodic : axis periodicity, see box_vectors
+    radius, noise_radius : radius of the convoys and of the background groups
+    drift, drift_period : amplitude and period in frames of the common motion
+    separation : least distance between the atoms of two lattice sites
+    seed : seed of the random generator, equal arguments give equal trajectories
+
+    Returns
+    -------
+    SyntheticTrajectory
+
+    For CMC to recover the planted convoys exactly, eps must exceed
+    2 * (radius + jitter) and stay below separation, k must not exceed the
+    shortest lifetime and m must lie between noise_group[1] + 1 and the
+    smallest convoy.
+    """
+    rng = np.random.default_rng(seed)
+    if box is None:
+        box = (float(np.cbrt(atoms / density)),) * 3
+    box = np.asarray(box, dtype=np.float64)
+
+    size_low, size_high = size_range(convoy_size)
+    life_low, life_high = size_range(lifetime)
+    life_high = min(life_high, frames)
+    if life_low > life_high:
+        raise ValueError(f'Convoy lifetime {lifetime} does not fit in {frames} frames')
+    sizes = rng.integers(size_low, size_high + 1, size=convoys)
+    siteAtoms = int(sizes.sum()) + hbond_sites * HB_SITE_ATOMS
+    if siteAtoms > atoms:
+        raise ValueError(f'{convoys} convoys and {hbond_sites} bond sites need {siteAtoms} atoms, got {atoms}')
+
+    # lattice cells of the sites, wide enough for the site, its drift and the separation
+    sites = convoys + hbond_sites
+    cells = max(1, int(np.ceil(np.cbrt(sites))))
+    spacing = box / cells
+    extent = max(radius, NO_BROKEN) + jitter
+    if sites and spacing.min() < max(2 * extent + separation, 2 * (extent + drift)):
+        raise ValueError(f'Box {box.tolist()} is too small for {sites} separated sites')
+    cell = np.stack(np.unravel_index(rng.choice(cells ** 3, sites, replace=False), (cells,) * 3), axis=1)
+    centers = (cell + 0.5) * spacing
+    phase = rng.random(3) * 2 * np.pi
+
+    # atom indices are shuffled so that no role is a contiguous index range
+    order = rng.permutation(atoms)
+    bounds = np.cumsum(sizes)
+    members = np.split(order[:siteAtoms - hbond_sites * HB_SITE_ATOMS], bounds[:-1]) if convoys else []
+    siteIndices = order[bounds[-1] if convoys else 0:siteAtoms].reshape(hbond_sites, HB_SITE_ATOMS)
+    noise = order[siteAtoms:]
+
+    lifetimes = rng.integers(life_low, life_high + 1, size=convoys)
+    starts = rng.integers(0, frames - lifetimes + 1)
+    shapes = [ball_offsets(rng, size, radius) for size in sizes]
+
+    siteShapes = [hb_site_offsets(rng) for _ in range(hbond_sites)]
+    bonded = rng.random((frames, hbond_sites)) < bond_fraction
+
+    positions = np.empty((frames, atoms, 3), dtype=np.float32)
+    hbonds = []
+    for frame in range(frames):
+        shift = drift * np.sin(2 * np.pi * frame / drift_period + phase)
+        coords = np.empty((atoms, 3))
+        background = [noise]
+        for c in range(convoys):
+            if starts[c] <= frame < starts[c] + lifetimes[c]:
+                coords[members[c]] = centers[c] + shift + shapes[c]
+            else:
+                background.append(members[c])
+
+        frameBonds = []
+        for s in range(hbond_sites):
+            shape = siteShapes[s][0 if bonded[frame, s] else 1]
+            coords[siteIndices[s]] = centers[convoys + s] + shift + shape
+            if bonded[frame, s]:
+                n, h, o = siteIndices[s, :3].tolist()
+                frameBonds.append([h, n, o])
+        hbonds.append(sorted(frameBonds))
+
+        background = rng.permutation(np.concatenate(background))
+        if noise_group is None:
+            coords[background] = rng.random((len(background), 3)) * box
+        else:
+            groupSizes = group_sizes(rng, len(background), *noise_group)
+            groupCenters = noise_radius + rng.random((len(groupSizes), 3)) * (box - 2 * noise_radius)
+            coords[background] = np.repeat(groupCenters, groupSizes, axis=0) + ball_offsets(rng, len(background), noise_radius)
+
+        positions[frame] = coords + rng.uniform(-jitter, jitter, size=coords.shape)
+
+    planted = [ConvoyCandidate(np.sort(members[c]), False, int(starts[c]), int(starts[c] + lifetimes[c] - 1)) for c in range(convoys)]
+    atomTypes = {
+        'n': siteIndices[:, 0].tolist(),
+        'hn': siteIndices[:, 1].tolist(),
+        'o': siteIndices[:, 2].tolist()
+    }
+    return SyntheticTrajectory(positions, tuple(box.tolist()), tuple(periodic), planted, hbonds, atomTypes)
+
+def convoy_key(convoy):
+    return tuple(np.asarray(convoy.indices).tolist()), int(convoy.start_time), int(convoy.end_time)
+
+def check_convoys(planted, detected):
+    """
+    Compare detected convoys with the planted ones
+
+    A planted convoy is recovered by a detected convoy of exactly its members,
+    first and last frame. Detected convoys matching no planted one are spurious.
+
+    Returns
+    -------
+    dict of planted, detected, recovered and spurious counts, recall and passed
+    """
+    plantedKeys = set(map(convoy_key, planted))
+    detectedKeys = set(map(convoy_key, detected))
+    recovered = len(plantedKeys & detectedKeys)
+    spurious = len(detectedKeys - plantedKeys)
+    return {
+        'planted': len(plantedKeys),
+        'detected': len(detected),
+        'recovered': recovered,
+        'spurious': spurious,
+        'recall': recovered / len(plantedKeys) if plantedKeys else 1.0,
+        'passed': recovered == len(plantedKeys) and spurious == 0
+    }
+
+def check_hbonds(planted, detected):
+    """
+    Compare detected hydrogen bonds with the planted ones, frame by frame
+
+    Returns
+    -------
+    dict of planted, missing and extra bond counts and passed
+    """
+    missing = extra = 0
+    for plantedBonds, detectedBonds in zip(planted, detected):
+        plantedBonds = set(map(tuple, plantedBonds))
+        detectedBonds = set(map(tuple, detectedBonds))
+        missing += len(plantedBonds - detectedBonds)
+        extra += len(detectedBonds - plantedBonds)
+    missing += sum(len(bonds) for bonds in planted[len(detected):])
+    return {
+        'planted': sum(len(bonds) for bonds in planted),
+        'missing': missing,
+        'extra': extra,
+        'passed': missing == 0 and extra == 0
+    }
@@ -0,0 +1,222 @@
+import os, glob, json, time, uuid, errno, fcntl, hashlib
+from contextlib import contextmanager
+
+from .storage import DATA_DIR, dataset_path
+
+# Upload sessions live next to the datasets, so finishing one is a rename
+UPLOAD_DIR = f'{DATA_DIR}/uploads'
+
+# Default and largest byte size of an upload chunk
+UPLOAD_CHUNK_SIZE = 64 * 1024 ** 2
+UPLOAD_MAX_CHUNK_SIZE = 1024 ** 3
+
+# Seconds an unfinished upload is kept after its last chunk
+UPLOAD_TTL = 7 * 24 * 3600
+
+# Bytes read from the request body at once
+STREAM_BLOCK = 1024 ** 2
+
+DIGEST_SIZE = 32
+
+class UploadError(ValueError):
+    """A chunk or upload that does not match its session"""
+
+class UploadLocked(UploadError):
+    """An upload another request is finishing"""
+
+def session_path(upload_id):
+    return f'{UPLOAD_DIR}/{upload_id}.json'
+
+def part_path(upload_id):
+    return f'{UPLOAD_DIR}/{upload_id}.part'
+
+def digests_path(upload_id):
+    return f'{UPLOAD_DIR}/{upload_id}.digests'
+
+def lock_path(upload_id):
+    return f'{UPLOAD_DIR}/{upload_id}.completing'
+
+def chunk_count(session):
+    return max(1, -(-session['size'] // session['chunk_size']))
+
+def chunk_range(session, index):
+    """ [start, end) byte range of a chunk """
+    start = index * session['chunk_size']
+    return start, min(start + session['chunk_size'], session['size'])
+
+def preallocate(path, size):
+    """ Create a file of size bytes, reserving the disk space where the file system allows it """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, max(size, 1))
+        except OSError as e:
+            # file systems without fallocate get a sparse file of the right size
+            if e.errno == errno.ENOSPC:
+                raise
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+def create_upload(filename, size, chunk_size=UPLOAD_CHUNK_SIZE, **owner):
+    """
+    Start an upload session
+
+    The dataset file is preallocated at its full size in UPLOAD_DIR, every
+    chunk is written straight into its place. The session keeps the SHA-256
+    of every received chunk in `<upload_id>.digests`, 32 bytes per chunk,
+    all zero until the chunk arrived.
+
+    Parameters
+    ----------
+    filename : name of the dataset once finished
+    size : total byte size
+    chunk_size : byte size of every chunk but the last
+    owner : kept in the session, e.g. user_id and company_id
+
+    Returns
+    -------
+    the session dict
+    """
+    if size <= 0 or not 0 < chunk_size <= UPLOAD_MAX_CHUNK_SIZE:
+        raise UploadError('Invalid size or chunk size')
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    expire_uploads()
+
+    session = dict(owner, upload_id=uuid.uuid4().hex, filename=filename, size=size, chunk_size=chunk_size, created=time.time())
+    try:
+        preallocate(part_path(session['upload_id']), size)
+        with open(digests_path(session['upload_id']), 'wb') as file:
+            file.truncate(chunk_count(session) * DIGEST_SIZE)
+        with open(session_path(session['upload_id']), 'w') as file:
+            json.dump(session, file)
+    except OSError:
+        remove_upload(session['upload_id'])
+        raise
+    return session
+
+def read_upload(upload_id):
+    """ The session of an upload, None when there is none """
+    try:
+        with open(session_path(os.path.basename(upload_id))) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def chunk_digests(session):
+    """ The SHA-256 digests of all chunks, None for chunks not received yet """
+    with open(digests_path(session['upload_id']), 'rb') as file:
+        data = file.read()
+    digests = [data[i:i + DIGEST_SIZE] for i in range(0, len(data), DIGEST_SIZE)]
+    return [digest if any(digest) else None for digest in digests]
+
+def missing_chunks(session):
+    return [index for index, digest in enumerate(chunk_digests(session)) if digest is None]
+
+def upload_checksum(session):
+    """
+    Checksum of a complete upload: the hex SHA-256 of the concatenated
+    binary SHA-256 digests of all chunks, in chunk order
+
+    Clients compute it chunk by chunk, the server from the digests taken while
+    the chunks streamed in, without reading the file again.
+    """
+    return hashlib.sha256(b''.join(chunk_digests(session))).hexdigest()
+
+def write_chunk(session, start, end, stream, sha256=None):
+    """
+    Write the bytes [start, end) of an upload from a stream
+
+    The range must be exactly one chunk. The body is copied in STREAM_BLOCK
+    pieces to its place in the preallocated file, so chunks of one upload can
+    arrive in any order and at the same time. A chunk sent again replaces the
+    earlier one.
+
+    Parameters
+    ----------
+    session : the upload session
+    start, end : byte range, end exclusive
+    stream : file-like object yielding end - start bytes
+    sha256 : optional expected hex SHA-256 of the chunk
+
+    Returns
+    -------
+    (chunk index, hex SHA-256 of the chunk)
+    """
+    index, offset = divmod(start, session['chunk_size'])
+    if offset or index >= chunk_count(session) or (start, end) != chunk_range(session, index):
+        raise UploadError(f'Range {start}-{end} is not a chunk of {session["chunk_size"]} bytes')
+
+    # a chunk sent again is missing until it arrived in full
+    mark_chunk(session, index, bytes(DIGEST_SIZE))
+
+    digest = hashlib.sha256()
+    fd = os.open(part_path(session['upload_id']), os.O_WRONLY)
+    try:
+        position = start
+        while position < end:
+            block = stream.read(min(STREAM_BLOCK, end - position))
+            if not block:
+                break
+            os.pwrite(fd, block, position)
+            digest.update(block)
+            position += len(block)
+    finally:
+        os.close(fd)
+
+    if position != end:
+        raise UploadError(f'Chunk {index} ended after {position - start} of {end - start} bytes')
+    if sha256 is not None and digest.hexdigest() != sha256.lower():
+        raise UploadError(f'Chunk {index} does not match its checksum')
+
+    mark_chunk(session, index, digest.digest())
+    os.utime(session_path(session['upload_id']))
+    return index, digest.hexdigest()
+
+def mark_chunk(session, index, digest):
+    """ Store the digest of a chunk, it counts as received unless the digest is all zero """
+    fd = os.open(digests_path(session['upload_id']), os.O_WRONLY)
+    try:
+        os.pwrite(fd, digest, index * DIGEST_SIZE)
+    finally:
+        os.close(fd)
+
+@contextmanager
+def lock_upload(upload_id):
+    """
+    Hold the exclusive lock on finishing an upload
+
+    The lock is a flock on `<upload_id>.completing`, the kernel releases it
+    when the holder dies, so a crashed request does not block the upload.
+    Raises UploadLocked when another request holds it.
+    """
+    fd = os.open(lock_path(upload_id), os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadLocked(f'Upload {upload_id} is being completed')
+        yield
+    finally:
+        os.close(fd)
+
+def finish_upload(session):
+    """ Move a complete upload to its dataset path and drop the session """
+    os.replace(part_path(session['upload_id']), dataset_path(session['filename']))
+    remove_upload(session['upload_id'])
+
+def remove_upload(upload_id):
+    """ Delete an upload session and its data """
+    for path in (session_path(upload_id), digests_path(upload_id), part_path(upload_id), lock_path(upload_id)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def expire_uploads(ttl=UPLOAD_TTL):
+    """ Delete uploads without a chunk in the last ttl seconds """
+    deadline = time.time() - ttl
+    for path in glob.glob(f'{UPLOAD_DIR}/*.json'):
+        try:
+            if os.path.getmtime(path) < deadline:
+                remove_upload(os.path.basename(path)[:-len('.json')])
+        except OSError:
+            continue
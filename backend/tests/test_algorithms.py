@@ -0,0 +1,181 @@
+import numpy as np
+import pytest
+
+from server.algorithms import CMC, CMCCheckpoint, ConvoyCandidate, FrameClusters, get_clusterer, shard_bounds
+from server.synthetic import generate_trajectory, check_convoys
+
+K, M, EPS = 5, 8, 3.5
+
+def baseline_fit_predict(clf, k, m, X):
+    """ The set based CMC loop the vectorized one replaced, on a frames first array """
+    convoy_candidates = set()
+    columns = len(X)
+    output_convoys = []
+    for column in range(columns):
+        current_convoy_candidates = set()
+        values = X[column]
+        if len(values) < m:
+            continue
+        clusters = clf.fit_predict(values)
+        unique_clusters = set(clusters)
+        clusters_indices = dict((cluster, ConvoyCandidate(indices=set(), is_assigned=False, start_time=None, end_time=None)) for cluster in unique_clusters)
+        for index, cluster_assignment in enumerate(clusters):
+            clusters_indices[cluster_assignment].indices.add(index)
+
+        for convoy_candidate in convoy_candidates:
+            convoy_candidate_indices = convoy_candidate.indices
+            convoy_candidate.is_assigned = False
+            for cluster in unique_clusters:
+                cluster_indices = clusters_indices[cluster].indices
+                cluster_candidate_intersection = cluster_indices & convoy_candidate_indices
+                if len(cluster_candidate_intersection) < m:
+                    continue
+                convoy_candidate.indices = cluster_candidate_intersection
+                current_convoy_candidates.add(convoy_candidate)
+                convoy_candidate.end_time = column
+                clusters_indices[cluster].is_assigned = convoy_candidate.is_assigned = True
+
+            candidate_life_time = (convoy_candidate.end_time - convoy_candidate.start_time) + 1
+            if (not convoy_candidate.is_assigned or column == columns - 1) and candidate_life_time >= k:
+                output_convoys.append(convoy_candidate)
+
+        for cluster in unique_clusters:
+            cluster_data = clusters_indices[cluster]
+            if cluster_data.is_assigned:
+                continue
+            cluster_data.start_time = cluster_data.end_time = column
+            current_convoy_candidates.add(cluster_data)
+        convoy_candidates = current_convoy_candidates
+    return output_convoys
+
+def convoy_keys(convoys):
+    """ Order independent form of a convoy list """
+    return sorted((tuple(sorted(np.asarray(list(convoy.indices) if isinstance(convoy.indices, set) else convoy.indices).tolist())),
+                   int(convoy.start_time), int(convoy.end_time)) for convoy in convoys)
+
+@pytest.fixture(scope='module')
+def trajectory():
+    return generate_trajectory(frames=40, atoms=300, convoys=3, lifetime=(10, 30), hbond_sites=0, seed=3)
+
+@pytest.fixture(scope='module')
+def clusterer(trajectory):
+    return get_clusterer('dbscan', EPS, trajectory.box, trajectory.periodic)
+
+@pytest.fixture(scope='module')
+def expected(trajectory, clusterer):
+    return convoy_keys(CMC(clusterer, K, M).fit_predict(trajectory.positions))
+
+def noisy_frames(seed=0):
+    """ Random points, with many short lived and overlapping candidates """
+    return (np.random.default_rng(seed).random((30, 120, 3)) * 12).astype(np.float32)
+
+def test_fit_predict_recovers_planted_convoys(trajectory, clusterer):
+    assert check_convoys(trajectory.convoys, CMC(clusterer, K, M).fit_predict(trajectory.positions))['passed']
+
+def test_fit_predict_matches_baseline(trajectory, clusterer, expected):
+    assert expected == convoy_keys(baseline_fit_predict(clusterer, K, M, trajectory.positions))
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('k, m', [(2, 3), (3, 2), (1, 4)])
+def test_fit_predict_matches_baseline_on_noise(seed, k, m):
+    X = noisy_frames(seed)
+    clf = get_clusterer('dbscan', 1.5, min_samples=2)
+    assert convoy_keys(CMC(clf, k, m).fit_predict(X)) == convoy_keys(baseline_fit_predict(clf, k, m, X))
+
+def test_frame_clusters_extend_matches_set_intersection():
+    rng = np.random.default_rng(1)
+    labels = rng.integers(-1, 6, size=80)
+    frame = FrameClusters(labels)
+    candidates = [ConvoyCandidate(np.sort(rng.choice(80, size, replace=False)), False, 0, 0) for size in (2, 10, 25, 40)]
+    chosen, assigned = frame.extend(candidates, 3)
+
+    clusters = {label: set(np.flatnonzero(labels == label).tolist()) for label in set(labels.tolist())}
+    hits = set()
+    for candidate, cluster in zip(candidates, chosen):
+        matches = [label for label in set(labels.tolist()) if len(clusters[label] & set(candidate.indices.tolist())) >= 3]
+        hits.update(matches)
+        # the last match in set order, like the set based loop
+        assert (frame.unique[cluster] if cluster >= 0 else None) == (matches[-1] if matches else None)
+        if cluster >= 0:
+            assert frame.intersection(candidate.indices, cluster).tolist() == sorted(clusters[frame.unique[cluster]] & set(candidate.indices.tolist()))
+    assert set(frame.unique[assigned].tolist()) == hits
+
+@pytest.mark.parametrize('chunk_size', [None, 7])
+def test_iter_predict_matches_fit_predict(trajectory, clusterer, expected, chunk_size):
+    cmc = CMC(clusterer, K, M, chunk_size=chunk_size)
+    assert convoy_keys(cmc.iter_predict(trajectory.positions)) == expected
+
+def test_iter_predict_yields_convoys_as_they_close(trajectory, clusterer):
+    frames = []
+    cmc = CMC(clusterer, K, M, on_frame=lambda column, *args: frames.append(column))
+    for convoy in cmc.iter_predict(trajectory.positions):
+        # a convoy closes on the frame after its last one, or at the end
+        assert frames[-1] == min(convoy.end_time + 1, len(trajectory.positions) - 1)
+
+@pytest.mark.parametrize('first_end', [1, 12, 25, 39])
+def test_resumed_run_matches_fresh_run(trajectory, clusterer, expected, first_end):
+    cmc = CMC(clusterer, K, M)
+    checkpoint = CMCCheckpoint()
+    first = list(cmc.iter_predict(trajectory.positions[:first_end], checkpoint=checkpoint))
+    assert checkpoint.frame == first_end
+    resumed = list(cmc.iter_predict(trajectory.positions, checkpoint=checkpoint))
+    assert convoy_keys(CMCCheckpoint(first_end).closed(first) + resumed) == expected
+
+def test_resumed_run_matches_fresh_run_on_noise():
+    X = noisy_frames(4)
+    cmc = CMC(get_clusterer('dbscan', 1.5, min_samples=2), 2, 3)
+    checkpoint = CMCCheckpoint()
+    first = list(cmc.iter_predict(X[:11], checkpoint=checkpoint))
+    resumed = list(cmc.iter_predict(X, checkpoint=checkpoint))
+    assert convoy_keys(CMCCheckpoint(11).closed(first) + resumed) == convoy_keys(cmc.fit_predict(X))
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_parallel_clustering_matches_in_process(trajectory, clusterer, expected, pool):
+    cmc = CMC(clusterer, K, M, n_jobs=2, pool=pool)
+    assert convoy_keys(cmc.fit_predict(trajectory.positions)) == expected
+
+def test_thread_and_process_pools_agree_on_noise():
+    X = noisy_frames(5)
+    clf = get_clusterer('periodic_dbscan', 1.5, box=(12, 12, 12), periodic=(True, True, True), min_samples=2)
+    results = [convoy_keys(CMC(clf, 2, 3, n_jobs=n_jobs, pool=pool).fit_predict(X)) for n_jobs, pool in ((1, 'process'), (3, 'thread'), (3, 'process'))]
+    assert results[0] == results[1] == results[2]
+
+def sharded_predict(cmc, X, shards):
+    parts = []
+    bounds = shard_bounds(len(X), shards)
+    for shard, (start, stop) in enumerate(bounds):
+        convoys, candidates = cmc.predict_shard(X[:stop], start, shard == len(bounds) - 1)
+        parts.append((start, stop, convoys, candidates))
+    return cmc.stitch_shards(X, parts)
+
+def test_shard_bounds():
+    assert shard_bounds(10, 3) == [(0, 3), (3, 7), (7, 10)]
+    assert shard_bounds(2, 5) == [(0, 1), (1, 2)]
+    assert shard_bounds(5, 1) == [(0, 5)]
+
+@pytest.mark.parametrize('shards', [2, 3, 4, 7, 40])
+def test_stitched_shards_match_single_pass(trajectory, clusterer, expected, shards):
+    # planted convoys span the shard boundaries
+    bounds = [start for start, _ in shard_bounds(len(trajectory.positions), shards)[1:]]
+    assert any(convoy.start_time < bound <= convoy.end_time for convoy in trajectory.convoys for bound in bounds)
+    convoys, _ = sharded_predict(CMC(clusterer, K, M), trajectory.positions, shards)
+    assert convoy_keys(convoys) == expected
+    assert [(convoy.end_time, convoy.start_time) for convoy in convoys] == sorted((convoy.end_time, convoy.start_time) for convoy in convoys)
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('k, m', [(2, 3), (4, 2), (1, 3)])
+def test_stitched_shards_match_single_pass_on_noise(seed, k, m):
+    X = noisy_frames(seed)
+    cmc = CMC(get_clusterer('dbscan', 1.5, min_samples=2), k, m)
+    single = convoy_keys(cmc.fit_predict(X))
+    for shards in (2, 3, 5, 30):
+        assert convoy_keys(sharded_predict(cmc, X, shards)[0]) == single
+
+def test_stitched_open_candidates_match_checkpoint():
+    X = noisy_frames(6)[:20]
+    cmc = CMC(get_clusterer('dbscan', 1.5, min_samples=2), 3, 3)
+    checkpoint = CMCCheckpoint()
+    list(cmc.iter_predict(X, checkpoint=checkpoint))
+    parts = [(start, stop) + cmc.predict_shard(X[:stop], start, False) for start, stop in shard_bounds(len(X), 3)]
+    _, candidates = cmc.stitch_shards(X, parts)
+    assert convoy_keys(candidates) == convoy_keys(checkpoint.candidates)
@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+
+from server import algorithms
+from server.algorithms import BOX_SIZE, HB_DISTANCE, NEIGHBOR_SEARCH_ATOMS, periodic_displacement, periodic_distance, hbond_triples, getHB
+
+L = BOX_SIZE[0]
+
+def scalar_wrap(x):
+    return L + x if x < 0 else x
+
+def scalar_periodic_boundary(x1, x2):
+    """ The scalar periodic difference the vectorized kernel replaced """
+    x1, x2 = scalar_wrap(x1), scalar_wrap(x2)
+    return ((x2 - x1) / abs(x2 - x1)) * (L - abs(x2 - x1)) if abs(x2 - x1) > L / 2 else (x2 - x1)
+
+def scalar_displacement(atom1, atom2):
+    """ Periodic along x and y, not along z """
+    return [scalar_periodic_boundary(atom1[0], atom2[0]), scalar_periodic_boundary(atom1[1], atom2[1]), atom2[2] - atom1[2]]
+
+def random_positions(rng, count):
+    """ Coordinates inside the box, a share of them given as negative periodic images """
+    X = rng.random((count, 3)) * L
+    negative = rng.random((count, 2)) < 0.2
+    X[:, :2] = np.where(negative, X[:, :2] - L, X[:, :2])
+    return X
+
+def test_periodic_displacement_matches_scalar():
+    rng = np.random.default_rng(0)
+    X1, X2 = random_positions(rng, 500), random_positions(rng, 500)
+    expected = np.array([scalar_displacement(a, b) for a, b in zip(X1, X2)])
+    assert np.allclose(periodic_displacement(X1, X2), expected)
+    distance, diff = periodic_distance(X1, X2)
+    assert np.allclose(diff, expected)
+    assert np.allclose(distance, np.linalg.norm(expected, axis=1))
+
+def test_periodic_displacement_crosses_the_boundary():
+    diff = periodic_displacement(np.array([0.5, L - 0.5, 1.0]), np.array([L - 0.5, 0.5, L - 1.0]))
+    # x and y have the minimum image length with the sign of the raw difference, z is not periodic
+    assert np.allclose(diff, [1.0, -1.0, L - 2.0])
+
+def test_periodic_displacement_broadcasts_frames_and_keeps_float32():
+    rng = np.random.default_rng(1)
+    frames = random_positions(rng, 4 * 30).reshape(4, 30, 3).astype(np.float32)
+    diff = periodic_displacement(frames[:, :, None], frames[:, None, :])
+    assert diff.shape == (4, 30, 30, 3) and diff.dtype == np.float32
+    assert np.allclose(diff[2, 3, 7], scalar_displacement(frames[2, 3].astype(np.float64), frames[2, 7].astype(np.float64)), atol=1e-4)
+
+def wrap(atom):
+    return np.array([scalar_wrap(atom[0]), scalar_wrap(atom[1]), atom[2]])
+
+def scalar_hbond(hn, n, o):
+    """ The scalar HB_truth the batched evaluation replaced """
+    no = scalar_displacement(n, o)
+    hnn = scalar_displacement(hn, n)
+    hno = scalar_displacement(hn, o)
+    angle = np.arccos(np.dot(hno, hnn) / (np.linalg.norm(hno) * np.linalg.norm(hnn)))
+    return 2.35619 < angle <= 3.14159 and np.sqrt(np.dot(no, no)) <= 3.5
+
+def scalar_hbonds(frames, hn, n, o):
+    """ (frame, hn, n, o) of every bonded triple, the N-O distance is tested first to keep it fast """
+    bonds = []
+    for f, frame in enumerate(frames):
+        close = [(j, k) for j in range(len(n)) for k in range(len(o))
+                 if np.linalg.norm(scalar_displacement(frame[n[j]], frame[o[k]])) <= HB_DISTANCE]
+        for i in range(len(hn)):
+            for j, k in close:
+                if scalar_hbond(frame[hn[i]], frame[n[j]], frame[o[k]]):
+                    bonds.append((f, hn[i], n[j], o[k]))
+    return bonds
+
+def hbond_frames(seed, sites, loose, frames=2):
+    """
+    Frames of N-H...O sites with random N-O distances and H-N-O angles around
+    the criteria, half of them astride the periodic boundaries, and loose
+    N, H and O atoms at random places
+    """
+    rng = np.random.default_rng(seed)
+    atoms = 3 * (sites + loose)
+    X = np.empty((frames, atoms, 3))
+    for f in range(frames):
+        X[f] = random_positions(rng, atoms)
+        n = X[f, :sites]
+        # sites astride x = 0 or y = 0, some with the N as a negative image
+        n[:sites // 2, rng.integers(0, 2)] = rng.uniform(-1.5, 1.5, sites // 2)
+        axis = rng.normal(size=(sites, 3))
+        axis /= np.linalg.norm(axis, axis=1, keepdims=True)
+        X[f, sites:2 * sites] = n + axis * rng.uniform(2.5, 4.2, (sites, 1))
+        tilt = rng.normal(size=(sites, 3)) * rng.uniform(0, 1.2, (sites, 1))
+        X[f, 2 * sites:3 * sites] = n + (axis + tilt) / np.linalg.norm(axis + tilt, axis=1, keepdims=True)
+        # keep the z axis inside the box, it is not periodic
+        X[f, :, 2] = np.abs(X[f, :, 2])
+    n_atoms = np.concatenate((np.arange(sites), np.arange(3 * sites, 3 * sites + loose)))
+    o_atoms = np.concatenate((np.arange(sites, 2 * sites), np.arange(3 * sites + loose, 3 * sites + 2 * loose)))
+    hn_atoms = np.concatenate((np.arange(2 * sites, 3 * sites), np.arange(3 * sites + 2 * loose, atoms)))
+    return X, hn_atoms, n_atoms, o_atoms
+
+@pytest.mark.parametrize('sites, loose', [(12, 10), (70, 70)])
+@pytest.mark.parametrize('neighbor_search', [None, False, True])
+def test_hbond_triples_match_scalar(sites, loose, neighbor_search):
+    X, hn, n, o = hbond_frames(0, sites, loose)
+    expected = scalar_hbonds(X, hn.tolist(), n.tolist(), o.tolist())
+    bonds = hbond_triples(X, hn, n, o, neighbor_search=neighbor_search)
+    assert [tuple(row) for row in bonds.tolist()] == expected
+    assert len(expected) > 4
+    # N-O pairs within the cutoff across the periodic boundary are candidates
+    assert any(np.abs(wrap(X[f, j]) - wrap(X[f, k]))[:2].max() > L / 2 and np.linalg.norm(scalar_displacement(X[f, j], X[f, k])) <= HB_DISTANCE
+               for f in range(len(X)) for j in n for k in o)
+
+@pytest.mark.parametrize('sites, loose', [(12, 10), (70, 70)])
+def test_neighbor_search_threshold(monkeypatch, sites, loose):
+    X, hn, n, o = hbond_frames(1, sites, loose)
+    used = []
+    pairs = algorithms.neighbor_pairs
+    monkeypatch.setattr(algorithms, 'neighbor_pairs', lambda *args: used.append(True) or pairs(*args))
+    bonds = hbond_triples(X, hn, n, o)
+    assert bool(used) == (len(n) + len(o) >= NEIGHBOR_SEARCH_ATOMS)
+    assert [tuple(row) for row in bonds.tolist()] == scalar_hbonds(X, hn.tolist(), n.tolist(), o.tolist())
+
+def test_get_hb_groups_bonds_by_frame():
+    X, hn, n, o = hbond_frames(2, 12, 10, frames=3)
+    grouped = getHB(X, {'hn': hn, 'n': n, 'o': o}, [2, 0])
+    expected = scalar_hbonds(X[[2, 0]], hn.tolist(), n.tolist(), o.tolist())
+    assert grouped == [[[h, b_n, b_o] for f, h, b_n, b_o in expected if f == frame] for frame in range(2)]
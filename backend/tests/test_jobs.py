@@ -0,0 +1,56 @@
+import json, base64
+import numpy as np
+import plotly.graph_objs as go
+from celery.backends.base import Backend
+
+from server.algorithms import ConvoyCandidate
+from server import results
+from server.routes import jobs
+from server.routes.jobs import convoy_labels, figure_json
+
+def test_convoy_labels_of_legacy_convoys():
+    convoys = [ConvoyCandidate({4, 1}, False, 0, 3), ConvoyCandidate(np.array([1, 2]), False, 1, 5)]
+    assert convoy_labels(convoys, 6).tolist() == [0, 0, 1, 0, 0, 0]
+
+class FakeTask(object):
+    def __init__(self, retries=0):
+        self.request = type('Request', (), {'retries': retries})()
+
+def test_waits_for_running_source_only(monkeypatch):
+    states = {}
+    monkeypatch.setattr(jobs.celery, 'AsyncResult', lambda job_id: type('Result', (), {'state': states[job_id]})())
+    monkeypatch.setattr(jobs, 'cache_lookup', lambda key: ('inflight', 'source'))
+    for state, waits in (('STARTED', True), ('PROGRESS', True), ('PENDING', False), ('SUCCESS', False), ('FAILURE', False)):
+        states['source'] = state
+        assert jobs.waits_for(FakeTask(), 'key', 'source') == waits
+    states['source'] = 'STARTED'
+    assert not jobs.waits_for(FakeTask(jobs.INFLIGHT_TTL // jobs.INFLIGHT_POLL), 'key', 'source')
+    # the marker now belongs to another job or expired
+    monkeypatch.setattr(jobs, 'cache_lookup', lambda key: (None, None))
+    assert not jobs.waits_for(FakeTask(), 'key', 'source')
+
+def test_failed_sharded_job_clears_inflight(tmp_path, monkeypatch):
+    monkeypatch.setattr(results, 'CACHE_DIR', str(tmp_path))
+    stitch = jobs.stitch_convoy_job.s(filename='dataset')
+    stitch.on_error(jobs.clear_convoy_inflight.s(cache_key='key'))
+    results.mark_inflight('key', 'stitch')
+    # the request a failed chord passes to the error callbacks of its body
+    request = type('Request', (), {'id': 'stitch', 'errbacks': stitch.options['link_error'], 'root_id': None})()
+    Backend(jobs.celery)._call_task_errbacks(request, RuntimeError('shard failed'), None)
+    assert results.cache_lookup('key') == (None, None)
+
+def scatter_figure():
+    return go.Figure(go.Scatter3d(x=np.linspace(0, 1, 5), y=np.arange(5, dtype=np.int64), z=np.full(5, 2.5), mode='markers'))
+
+def test_figure_json_base64_sends_float32():
+    trace = json.loads(figure_json(scatter_figure(), 'base64'))['data'][0]
+    assert trace['x']['dtype'] == 'f4'
+    assert np.allclose(np.frombuffer(base64.b64decode(trace['x']['bdata']), dtype='<f4'), np.linspace(0, 1, 5))
+    assert trace['y']['dtype'] in ('i1', 'i4')
+    assert np.frombuffer(base64.b64decode(trace['y']['bdata']), dtype=trace['y']['dtype']).tolist() == list(range(5))
+
+def test_figure_json_json_sends_numbers():
+    trace = json.loads(figure_json(scatter_figure(), 'json'))['data'][0]
+    assert trace['x'] == np.linspace(0, 1, 5).tolist()
+    assert trace['y'] == list(range(5))
+    assert trace['z'] == [2.5] * 5
@@ -0,0 +1,41 @@
+import os, json, time, socket, subprocess
+import numpy as np
+import pytest
+
+from server import metrics
+
+def write_snapshot(path, runs):
+    with open(path, 'w') as file:
+        json.dump({'task_runs_total': {metrics.Registry.label_key({'task': 'convoy_job'}): runs}}, file)
+
+def test_merged_values_drop_snapshots_of_exited_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    exited = subprocess.Popen(['true'])
+    exited.wait()
+    host = socket.gethostname()
+    write_snapshot(f'{tmp_path}/{host}-{os.getpid()}.json', 2)
+    write_snapshot(f'{tmp_path}/{host}-{exited.pid}.json', 3)
+    write_snapshot(f'{tmp_path}/other-host-1.json', 5)
+    write_snapshot(f'{tmp_path}/stale-host-1.json', 7)
+    old = time.time() - metrics.SNAPSHOT_TTL - 1
+    os.utime(f'{tmp_path}/stale-host-1.json', (old, old))
+
+    merged = metrics.merged_values()
+    assert list(merged['task_runs_total'].values()) == [7]
+    assert sorted(os.listdir(tmp_path)) == sorted([f'{host}-{os.getpid()}.json', 'other-host-1.json'])
+
+def test_remove_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    metrics.flush()
+    assert os.path.exists(metrics.snapshot_path())
+    metrics.remove_snapshot()
+    assert not os.path.exists(metrics.snapshot_path())
+
+def test_peak_rss_is_reset_between_tasks():
+    if metrics.peak_rss() is None:
+        pytest.skip('no /proc')
+    block = np.ones(64 * 1024 ** 2, dtype=np.uint8)
+    high = metrics.peak_rss()
+    del block
+    metrics.reset_peak_rss()
+    assert metrics.peak_rss() < high - 32 * 1024 ** 2
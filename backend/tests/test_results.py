@@ -0,0 +1,63 @@
+import os, pickle, time
+import pytest
+
+from server.algorithms import ConvoyCandidate
+from server import results
+from server.results import ConvoyTable, job_convoys, job_convoy_members, cache_lookup, mark_inflight, clear_inflight, inflight_path
+
+def legacy_convoys():
+    """ Convoys as pickled by jobs storing their result in the result backend, members as a set """
+    return pickle.loads(pickle.dumps([
+        ConvoyCandidate({7, 3, 5}, False, 2, 9),
+        ConvoyCandidate({1, 4}, True, 0, 4)
+    ]))
+
+def test_convoy_table_from_legacy_convoys():
+    table = ConvoyTable.from_convoys(legacy_convoys())
+    assert len(table) == 2
+    assert table.members(0).tolist() == [3, 5, 7]
+    assert table.members(1).tolist() == [1, 4]
+    assert table.column('size').tolist() == [3, 2]
+    assert table.serialize([0], members=True) == [{'index': 0, 'num_of_indices': 3, 'start_time': 2, 'end_time': 9, 'indices': [3, 5, 7]}]
+
+def test_convoy_table_from_no_convoys():
+    table = ConvoyTable.from_convoys([])
+    assert len(table) == 0
+    assert table.query().tolist() == []
+
+class PickledJob(object):
+    """ AsyncResult of a job storing its pickled result in the result backend """
+    def __init__(self, result):
+        self.id = 'legacy'
+        self.result = result
+
+def test_job_convoys_of_legacy_job():
+    convoys = job_convoys(PickledJob(pickle.dumps(legacy_convoys())))
+    assert [convoy.indices.tolist() for convoy in convoys] == [[3, 5, 7], [1, 4]]
+
+def test_inflight_marker(tmp_path, monkeypatch):
+    monkeypatch.setattr(results, 'CACHE_DIR', str(tmp_path))
+    assert cache_lookup('key') == (None, None)
+    mark_inflight('key', 'job')
+    assert cache_lookup('key') == ('inflight', 'job')
+    clear_inflight('key', 'other')
+    assert cache_lookup('key') == ('inflight', 'job')
+    clear_inflight('key', 'job')
+    assert cache_lookup('key') == (None, None)
+
+def test_stale_inflight_marker_is_ignored(tmp_path, monkeypatch):
+    monkeypatch.setattr(results, 'CACHE_DIR', str(tmp_path))
+    mark_inflight('key', 'job')
+    old = time.time() - results.INFLIGHT_TTL - 1
+    os.utime(inflight_path('key'), (old, old))
+    assert cache_lookup('key') == (None, None)
+
+def test_job_convoy_members(tmp_path, monkeypatch):
+    monkeypatch.setattr(results, 'RESULTS_DIR', str(tmp_path))
+    job = PickledJob({'kind': 'convoys'})
+    results.write_convoy_file(results.convoy_result_path(job.id), job_convoys(PickledJob(pickle.dumps(legacy_convoys()))))
+    assert job_convoy_members(job, 0).tolist() == [3, 5, 7]
+    assert job_convoy_members(PickledJob(pickle.dumps(legacy_convoys())), 1).tolist() == [1, 4]
+    for position in (2, -1):
+        with pytest.raises(IndexError):
+            job_convoy_members(job, position)
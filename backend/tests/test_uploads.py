@@ -0,0 +1,33 @@
+import os
+import pytest
+
+from server import uploads
+from server.uploads import UploadError, create_upload, missing_chunks
+
+@pytest.fixture
+def upload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, 'UPLOAD_DIR', str(tmp_path))
+    return tmp_path
+
+@pytest.mark.parametrize('size, chunk_size', [(0, 4), (-1, 4), (10, 0), (10, uploads.UPLOAD_MAX_CHUNK_SIZE + 1)])
+def test_create_upload_rejects_invalid_sizes(upload_dir, size, chunk_size):
+    with pytest.raises(UploadError):
+        create_upload('data.npy', size, chunk_size)
+    assert os.listdir(upload_dir) == []
+
+def test_create_upload(upload_dir):
+    session = create_upload('data.npy', 10, 4, user_id=1)
+    assert session['user_id'] == 1
+    assert missing_chunks(session) == [0, 1, 2]
+
+def test_lock_upload_is_exclusive(upload_dir):
+    session = create_upload('data.npy', 10, 4)
+    with uploads.lock_upload(session['upload_id']):
+        with pytest.raises(uploads.UploadLocked):
+            with uploads.lock_upload(session['upload_id']):
+                pass
+    # released on exit
+    with uploads.lock_upload(session['upload_id']):
+        pass
+    uploads.remove_upload(session['upload_id'])
+    assert os.listdir(upload_dir) == []
@@ -3,11 +3,16 @@
 import React, { useState, useEffect } from "react";
 import { UserContext } from '@/service/userService';
 import base_url from "@/service/api";
+import { isConvoyJob, fetchConvoys } from "@/service/jobs";
 import { useRouter } from 'next/navigation';
 
+// Convoys per table page
+const PAGE_SIZE = 100;
+
 export default function Page({ params }) {
     
     const [job, setJob] = useState([]);
+    const [page, setPage] = useState(null);
     const [error, setError] = useState({});
     const userData = React.useContext(UserContext);
     const [loading, setLoading] = useState(true);
@@ -23,6 +28,9 @@ export default function Page({ params }) {
                     const data = await response.json();
                     setJob(data);
                     console.log(data);
+                    if(data.result && data.result.kind === "convoys"){
+                        getConvoys(0);
+                    }
                 }
                 else{
                     setError({message: "There was an error retrieving the requested job."});
@@ -36,6 +44,12 @@ export default function Page({ params }) {
         }
     }, [userData]);
 
+    const getConvoys = (offset) => {
+        fetchConvoys(params.id, userData.token, offset, PAGE_SIZE)
+        .then(data => setPage(data))
+        .catch(() => setError({message: "There was an error retrieving the convoys of the job."}));
+    }
+
     if(loading){
         return(
         <section className="bg-gray-50 dark:bg-gray-900 h-full">
@@ -55,9 +69,9 @@ export default function Page({ params }) {
         <div className="p-6">
             <h2 className="text-gray-900 text-4xl font-extrabold dark:text-white pb-8">Job {params.id}</h2>
             <h4 className="text-gray-700 text-lg font-semibold dark:text-white pb-2" >Status: {job.status}</h4>
-            <h4 className="text-gray-700 text-lg font-semibold dark:text-white pb-2" >Job Type: {job.job_name === "server.routes.jobs.convoy_job" ? "Basic Convoy" : "HB"}</h4>
+            <h4 className="text-gray-700 text-lg font-semibold dark:text-white pb-2" >Job Type: {isConvoyJob(job) ? "Basic Convoy" : "HB"}</h4>
             <h4 className="text-gray-700 text-lg font-semibold dark:text-white pb-8" >Start Date: {new Date(job.date_done).toLocaleString()}</h4>
-            {(job.result && job.result.length && job.result[0] !== null) && 
+            {(page && page.convoys.length > 0) && 
             <div>
             <div className="flex flex-row">
             <div className="relative overflow-x-auto shadow-md sm:rounded-lg basis-3/4">
@@ -82,10 +96,10 @@ export default function Page({ params }) {
                         </tr>
                     </thead>
                     <tbody>
-                        {job.result.map((convoy, index) => 
-                        <tr key={index} class="odd:bg-white odd:dark:bg-gray-900 even:bg-gray-50 even:dark:bg-gray-800 border-b dark:border-gray-700">
+                        {page.convoys.map((convoy) => 
+                        <tr key={convoy.index} class="odd:bg-white odd:dark:bg-gray-900 even:bg-gray-50 even:dark:bg-gray-800 border-b dark:border-gray-700">
                             <th scope="row" class="px-6 py-4 font-medium text-gray-900 whitespace-nowrap dark:text-white">
-                                Convoy {index + 1}
+                                Convoy {convoy.index + 1}
                             </th>
                             <td class="px-6 py-4">
                                 {convoy.num_of_indices}
@@ -97,7 +111,7 @@ export default function Page({ params }) {
                                 {convoy.end_time}
                             </td>
                             <td class="px-6 py-4">
-                                <a className="hover:underline" onClick={() => router.push("/home/visualization/" + params.id + "/" + index)}>Visualize</a>
+                                <a className="hover:underline" onClick={() => router.push("/home/visualization/" + params.id + "/" + convoy.index)}>Visualize</a>
                             </td>
                         </tr>
                         )}
@@ -105,6 +119,11 @@ export default function Page({ params }) {
                 </table>
             </div>
             </div>
+            <div className="flex flex-row items-center gap-4 my-4">
+                <button disabled={page.offset === 0} onClick={() => getConvoys(Math.max(0, page.offset - PAGE_SIZE))} className="bg-gray-200 hover:bg-gray-300 font-bold py-2 px-4 rounded disabled:opacity-50">Previous</button>
+                <span className="text-gray-700 dark:text-white">Convoys {page.offset + 1} to {page.offset + page.convoys.length} of {page.total}</span>
+                <button disabled={page.offset + PAGE_SIZE >= page.total} onClick={() => getConvoys(page.offset + PAGE_SIZE)} className="bg-gray-200 hover:bg-gray-300 font-bold py-2 px-4 rounded disabled:opacity-50">Next</button>
+            </div>
             <button onClick ={() => router.push("/home/visualization/" + params.id)} className= "bg-blue-500 hover:bg-blue-700 text-white font-bold py-2 px-4 rounded my-4 mx-0">Visualize Convoy Context</button>
             </div>
             }
@@ -3,6 +3,7 @@
 import React, { useState, useEffect } from "react";
 import { UserContext } from '@/service/userService';
 import base_url from "@/service/api";
+import { isConvoyJob } from "@/service/jobs";
 import { useRouter } from 'next/navigation';
 
 export default function Jobs() {
@@ -102,7 +103,7 @@ export default function Jobs() {
                                     {job.dataset}
                                 </td>
                                 <td class="px-6 py-4">
-                                    {job.job_name === "server.routes.jobs.convoy_job" ? "Basic Convoy" : "HB"}
+                                    {isConvoyJob(job) ? "Basic Convoy" : "HB"}
                                 </td>
                                 <td class="px-6 py-4">
                                     {(new Date(job.start_time)).toLocaleString()}
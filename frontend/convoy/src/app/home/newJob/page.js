@@ -3,6 +3,7 @@
 import React, { useState, useEffect } from "react";
 import { UserContext } from '@/service/userService';
 import base_url from "@/service/api";
+import { isConvoyJob, fetchConvoys } from "@/service/jobs";
 
 export default function NewJob() {
 
@@ -22,6 +23,7 @@ export default function NewJob() {
     const [error, setError] = useState(false);
     const [jobs, setJobs] = useState([]);
     const [job, setJob] = useState({});
+    const [convoys, setConvoys] = useState(null);
 
     const handleChange = (e) => {
         setParams({
@@ -72,8 +74,9 @@ export default function NewJob() {
     }
 
     const onStartHbJob = async () => {
-        const conStart = job.result[Number(params.index)].start_time
-        const conEnd = job.result[Number(params.index)].end_time
+        const convoy = convoys.find((convoy) => convoy.index === Number(params.index));
+        const conStart = convoy.start_time
+        const conEnd = convoy.end_time
         
         console.log(params);
         const body = {
@@ -107,7 +110,7 @@ export default function NewJob() {
         .then(async response => {
             if(response.ok){
                 const data = await response.json();
-                const filteredJobs = data.jobs.filter((job) => job.status === "SUCCESS" && job.dataset == dataset && job.job_name == "server.routes.jobs.convoy_job")
+                const filteredJobs = data.jobs.filter((job) => job.status === "SUCCESS" && job.dataset == dataset && isConvoyJob(job))
                 console.log(filteredJobs);
                 setJobs(filteredJobs.sort((a, b) => new Date(a.start_time) > new Date(b.start_time) ? -1 : 1));
                 if(data.jobs.length == 0){
@@ -128,6 +131,10 @@ export default function NewJob() {
                 const data = await response.json();
                 setJob(data);
                 console.log(data);
+                // the first page of convoys, as many as the API serves at once
+                fetchConvoys(convoy_id, userData.token, 0, 1000)
+                .then(page => setConvoys(page.convoys))
+                .catch(() => setError({message: "There was an error retrieving the convoys of the job."}));
             }
             else{
                 setError({message: "There was an error retrieving the requested job."});
@@ -275,7 +282,7 @@ export default function NewJob() {
                 {params.convoy_id &&
                 <div>
                     {
-                        !job || !job.result ? 
+                        !job || !convoys ? 
                         <section className="bg-gray-50 dark:bg-gray-900 h-full">
                             <div role="status" className='h-full flex justify-center content-center'>
                                 <div className="flex items-center content-center">
@@ -294,7 +301,7 @@ export default function NewJob() {
                                 <label htmlFor="index" className="block mb-2 text-sm font-medium text-gray-900 dark:text-white">Convoy Index<span className="text-red-700">*</span></label>
                                 <select value={params.index} onChange={handleChange} id="index" type="index" name="index" className="bg-gray-50 border border-gray-300 text-gray-900 sm:text-sm rounded-lg focus:ring-primary-600 focus:border-primary-600 block w-full p-2.5 dark:bg-gray-700 dark:border-gray-600 dark:placeholder-gray-400 dark:text-white dark:focus:ring-blue-500 dark:focus:border-blue-500">
                                     <option value="" disabled hidden>Choose here</option>
-                                    {job.result.map((convoy, index)=> <option key={index} value={index}>{index + 1}</option>)}
+                                    {convoys.map((convoy)=> <option key={convoy.index} value={convoy.index}>{convoy.index + 1}</option>)}
                                 </select>
                             </div>
                         </div>
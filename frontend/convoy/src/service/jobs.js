@@ -0,0 +1,13 @@
+import base_url from "@/service/api";
+
+// Task names of jobs whose result is a convoy list, sharded jobs finish in the stitch job
+const convoy_jobs = ['server.routes.jobs.convoy_job', 'server.routes.jobs.stitch_convoy_job'];
+
+export const isConvoyJob = (job) => convoy_jobs.includes(job.job_name);
+
+// One page of the convoys of a finished convoy job, {total, offset, limit, convoys}
+export const fetchConvoys = (job_id, token, offset = 0, limit = 100) => {
+    const headers = { 'Authorization': 'Bearer ' + token };
+    return fetch(base_url + 'job/' + job_id + '/convoys?offset=' + offset + '&limit=' + limit, { headers })
+    .then(response => response.ok ? response.json() : Promise.reject(response));
+}
@@ -0,0 +1,16 @@
+-- Upgrade an existing database: dataset statistics recorded at upload
+
+use convoy;
+
+ALTER TABLE datasets
+    ADD COLUMN frame_count INT,
+    ADD COLUMN atom_count INT,
+    ADD COLUMN dtype VARCHAR(16),
+    ADD COLUMN min_x FLOAT,
+    ADD COLUMN min_y FLOAT,
+    ADD COLUMN min_z FLOAT,
+    ADD COLUMN max_x FLOAT,
+    ADD COLUMN max_y FLOAT,
+    ADD COLUMN max_z FLOAT,
+    ADD COLUMN content_hash CHAR(64),
+    ADD COLUMN atom_types TEXT;
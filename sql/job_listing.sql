@@ -0,0 +1,5 @@
+-- Upgrade an existing database: index for the paginated, date filtered job listing
+
+use convoy;
+
+CREATE INDEX jobs_company_start ON jobs (company_id, start_time);
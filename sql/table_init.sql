@@ -39,6 +39,17 @@ CREATE TABLE IF NOT EXISTS datasets (
     dataset_name VARCHAR(100) NOT NULL,
     company_id INT,
     user_id INT,
+    frame_count INT,
+    atom_count INT,
+    dtype VARCHAR(16),
+    min_x FLOAT,
+    min_y FLOAT,
+    min_z FLOAT,
+    max_x FLOAT,
+    max_y FLOAT,
+    max_z FLOAT,
+    content_hash CHAR(64),
+    atom_types TEXT,
     FOREIGN KEY (company_id) REFERENCES companies(company_id),
     FOREIGN KEY (user_id) references users(user_id)
 );
@@ -49,6 +60,8 @@ CREATE TABLE IF NOT EXISTS jobs (
     dataset_id INT,
     user_id INT,
     company_id INT,
+    start_time DATETIME,
+    INDEX jobs_company_start (company_id, start_time),
     FOREIGN KEY (user_id) REFERENCES users(user_id),
     FOREIGN KEY (dataset_id) REFERENCES datasets(dataset_id),
     FOREIGN KEY (company_id) REFERENCES companies(company_id)